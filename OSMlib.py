@@ -10,12 +10,7 @@ import inside
 from astropy.io import ascii
 import os
 from scipy.special import jn
-
-from pyfft.cuda import Plan
-import pycuda.driver as cuda
-from pycuda.tools import make_default_context
-import pycuda.autoinit
-import pycuda.gpuarray as gpuarray
+from collections import OrderedDict
 
 #Constants
 NG=6.67384e-8 #Newton's Gravity in cm^3/g/s^2
@@ -28,6 +23,33 @@ h=6.626e-27 #Planck's constant in cm^2*g/s
 c=3e10 #Speed of light, cm/s
 k=1.381e-16 #Boltzmann constant erg/K
 
+#FFT settings (see image_fft). These can be changed by the driver before calling osm.
+fft_lib='auto'	#'numpy', 'scipy' (scipy.fft), 'fftw' (pyFFTW), or 'auto' to use the fastest one that is installed
+fft_threads=1	#The number of threads scipy.fft and pyFFTW get to use for each transform
+fft_plans=dict()	#Holds the image buffers and FFT plans between calls, keyed by backend and image shape
+
+#Model image settings (see image_grid)
+vis_pixels=1000	#Roughly how many pixels of the model image land on the star. This sets the pixel size.
+vis_accuracy=1e-3	#Target for the error in the visibilities from interpolating off of the FFT. This sets the image size.
+perim_len=200	#Number of points on the star's perimeter (see limb_perimeter). 0 uses the convex hull of the visible grid points instead.
+use_symmetry=True	#Work out the surface integrals in calc_phot and calc_Lbol over half the longitudes (and half the colatitudes for L_bol) when the star is symmetric (see phi_fold and colat_fold)
+
+phx_session=dict()	#Holds what read_phoenix gives back for the rest of the run (see phoenix_grid)
+phx_packs=dict()	#The memory mapped phoenix grids that have been opened (see open_phoenix_pack)
+phx_bands=dict()	#The precomputed band integrated phoenix intensities that have been loaded (see cached_bands)
+band_files=dict()	#The names band_cache_file has worked out for each set of bands (see band_key), so the filter curves are only hashed once
+warm_setup=dict()	#What warm_cell needs in each worker process (see warm_phoenix)
+phx_bols=dict()	#The hemispheric fluxes and wavelength integrated intensities of the phoenix models, for each grid (see phoenix_bol_cell)
+phx_pcas=dict()	#The compressed phoenix grids that have been loaded (see open_phoenix_pca)
+phx_weights=dict()	#The band integration matrices for each set of bands (see band_weights and band_key)
+phx_catalogs=dict()	#What's available of each phoenix grid, scanned once (see phoenix_catalog)
+phx_source='ftp://phoenix.astro.physik.uni-goettingen.de/SpecIntFITS/PHOENIX-ACES-AGSS-COND-SPECINT-2011/'	#Where models that aren't in phx_dir come from (a URL or a directory)
+phx_mirror=True	#Save models fetched from phx_source into phx_dir, so later runs have them (see fetch_phoenix)
+phx_cache_bytes=2*1024**3	#Most memory the phoenix models in phx_dict can take up. Past this the least recently used full spectra get dropped, then whole models (see phoenix_cache)
+phx_storage='as read'	#How the phoenix models in phx_dict are stored: 'as read' (full spectra as they come from the files, float32 for the phoenix FITS files, band integrals as float64), 'float32', or 'float16' (full spectra as float16 scaled row by row, band integrals as float32). See storage_report for what it does to chi^2 and luminosities.
+phx_tables=True	#Use the tables precomputed next to the grid (see precompute_bands and precompute_bol) instead of working the band and bolometric integrals out from the spectra
+phx_lru=OrderedDict()	#Every phoenix model that's been loaded, least recently used first: id(entry) -> [entry,bytes of its full spectrum,bytes of its band integrals], where entry is the model's [unfiltered,phot_filtered,vis_filtered] in its phx_dict
+
 def osm(p,data):
 	"""osm = Oblate Star Model
 	This function calculates the total chi^2 (from photometry and visibilities)
@@ -44,6 +66,7 @@ def osm(p,data):
 		The total chi^2 (chi^2_phot+chi^2_vis)
 	"""
 	base_chi2,m,beta,dist,vis,vis_err,phot_data,wl,u_l,v_l,u_m,v_m,uni_wl,uni_dwl,g_scale,phx_dir,use_Z,use_filts,filt_dict,zpf,cwl,phx_dict,colat_len,phi_len,cal,star,model,model_dir,mode=data
+	#g_scale isn't used anymore (image_grid sets the scale of the model image), but it's kept so the drivers' data lists still line up
 	
 	ministarttime=time.time()
 	#print p
@@ -59,130 +82,20 @@ def osm(p,data):
 	#try:
 	n_params=5.
 	
-	#Define the latitude/longitude grid
-	colat=unitrange(colat_len-1)*np.pi
-	sin_colat=np.zeros(len(colat))
-	cos_colat=np.zeros(len(colat))
-	phi=unitrange(phi_len-1)*2.*np.pi
-	sin_phi=np.zeros(len(phi))
-	cos_phi=np.zeros(len(phi))
-	for i in range(len(colat)):
-		sin_colat[i]=np.sin(colat[i])
-		cos_colat[i]=np.cos(colat[i])
-	for i in range(len(phi)):
-		sin_phi[i]=np.sin(phi[i])
-		cos_phi[i]=np.cos(phi[i])
-	
-	#Calculated values
-	R_p=1./(1./R_e+(vel*1e5)**2./(2.*(NG*M_sun/R_sun)*m))	#Polar Radius
-	#print 'R_p: ',R_p
-	w_0=(vel*1e5)**2.*R_p/(2.*(NG*M_sun/R_sun)*m)
-	lomg=np.sqrt(27./4.*w_0*(1.-w_0)**2.)			#angular rotational velocity relative to the critical
-	if 'z' in mode:
-		beta=0.25
-	if 'r' in mode:
-		beta=calc_beta(lomg)
-	OMG_crit=np.sqrt(8./27.*NG*m*M_sun/(R_p*R_sun)**3.)	#Critical angular rotational velocity
-	OMG=lomg*OMG_crit				#angular rotational velocity
-	g_p=NG*(m*M_sun)/(R_p*R_sun)**2.			#Polar surface gravity
-	#Populate the latitude/longitude grid
-	R=np.zeros(len(colat))
-	g=np.zeros(len(colat))
-	g_r=np.zeros(len(colat))
-	g_t=np.zeros(len(colat))
-	lg=np.zeros(len(colat))
-	#This defines the physical radius (in solar radii) and surface gravity of the star as a function of colatitude
-	for i in range(len(colat)):
-		if colat[i]==0.:
-			R[i]=R_p
-		elif colat[i]==np.pi:
-			R[i]=R_p
-		else:
-			if lomg == 0.:
-				R[i]=R_p
-			else:
-				R[i]=3.*R_p/(lomg*sin_colat[i])*np.cos((np.pi+np.arccos(lomg*sin_colat[i]))/3.)
-		g_r[i]=-NG*(m*M_sun)/(R[i]*R_sun)**2.+R[i]*R_sun*(OMG*sin_colat[i])**2.
-		g_t[i]=R[i]*R_sun*OMG**2.*sin_colat[i]*cos_colat[i]
-		g[i]=np.sqrt(g_r[i]**2.+g_t[i]**2.)
-		lg[i]=np.log10(g[i])
-	#More calculations that need to be done
-	tht_Re=(R_e*R_sun)/(dist*pc)	#Angular Equatorial Radius in radians
-	tht_Rp=(R_p*R_sun)/(dist*pc)	#Angular Polar Radius in radians
-	tht_R=(R*R_sun)/(dist*pc)	#Angular Radius as a function of colatitude in radians
-	T_eff=T_p*(g/g_p)**beta	#Effective temperature as a function of colatitude in Kelvins
-	
-	#Setting up some arrays
-	orig_x=np.zeros((len(colat),len(phi)))	#x coordinate before inclination and rotation
-	orig_y=np.zeros((len(colat),len(phi)))	#y coordinate before inclination and rotation
-	orig_z=np.zeros((len(colat),len(phi)))	#z coordinate before inclination and rotation
-	mu=np.zeros((len(colat),len(phi)))	#cosine of the angle between the normal of the star and the observer
-	#I don't think this is necessary anymore, but I don't have time to test right now:
-	#emit=zeros(len(colat))		#The intensity emitted as a function of colatitude
-	#int=zeros((len(colat),len(phi)))	#The intensity observed (before limb-darkening) as a function of colatitude and longitude
-	
-	#This bit calculates the x,y,z coordinates of each point on the grid as well as mu, the cosine of the angle between the normal of the star and the observer
-	for i in range(len(colat)):
-		A=tht_R[i]*sin_colat[i]
-		B=tht_R[i]*cos_colat[i]
-		C=tht_R[i]*sin_colat[i]
-		for j in range(len(phi)):
-			orig_x[i,j]=A*sin_phi[j]
-			orig_y[i,j]=B
-			orig_z[i,j]=C*cos_phi[j]
-			mu[i,j]=1.0/g[i]*(-1.0*g_r[i]*(sin_colat[i]*sin_inc*cos_phi[j]+cos_colat[i]*cos_inc)-g_t[i]*(sin_inc*cos_phi[j]*cos_colat[i]-sin_colat[i]*cos_inc))
-	#unrot_x,y,z have been inclined, but not rotated
-	unrot_x=orig_x
-	unrot_y=orig_y*sin_inc-orig_z*cos_inc
-	unrot_z=orig_y*cos_inc+orig_z*sin_inc
-	#x,y,z have been both inclined and rotated
-	x=unrot_x*cos_pa-unrot_y*sin_pa
-	y=unrot_x*sin_pa+unrot_y*cos_pa
-	z=unrot_z
-	#Defining above/below x,y,z's ("above" are points are the points the observer sees)
-	x_above=[]
-	y_above=[]
-	z_above=[]
-	#int_above=[]
-	x_below=[]
-	y_below=[]
-	z_below=[]
-	#int_below=[]
-	for i in range(len(colat)):
-		for j in range(len(phi)):
-			if z[i,j] >= 0. and mu[i,j] > 0.:
-				x_above.append(x[i,j])
-				y_above.append(y[i,j])
-				z_above.append(z[i,j])
-				#int_above.append(int[i,j])
-				#print 'i,j: {},{} || Colatitude: {} deg || Longitude: {} deg || x_above: {} mas || y_above: {} mas'.format(i,j,colat[i]*180./np.pi,phi[j]*180./np.pi,x[i,j]*206264806.,y[i,j]*206264806.)
-			else:
-				x_below.append(x[i,j])
-				y_below.append(y[i,j])
-				z_below.append(z[i,j])
-				#int_below.append(int[i,j])
-	#Define the perimeter of the "above" points
-	points=[]
-	for i in range(len(x_above)):
-		points.append((x_above[i],y_above[i]))
-	points=np.array(points)
-	
-	hull=ConvexHull(points)
-	slist=[]
-	xlist=[]
-	ylist=[]
-	for simplex in hull.simplices:
-		slist.append(simplex)
-		xlist.append(points[simplex,0])
-		ylist.append(points[simplex,1])
-	sarr=np.array(slist)
-	xarr=np.array(xlist)
-	yarr=np.array(ylist)
-	perim_x,perim_y=sort_hull_results(sarr,xarr,yarr) #perim_x and perim_y define the perimeter of the star from the observer's perspective
+	colat,phi,sin_colat,cos_colat,cos_phi,R_p,lomg,OMG,g_p,beta,R,tht_R,g,g_r,g_t,lg,T_eff,mu,x,y,z=surface_grid(p,m,beta,dist,colat_len,phi_len,mode)
+	#Defining the "above" points (the points the observer sees)
+	above=(z >= 0.)&(mu > 0.)
+	x_above=x[above]
+	y_above=y[above]
+	#Define the perimeter of the star from the observer's perspective
+	if perim_len > 0:
+		perim_x,perim_y=limb_perimeter(p,R_p,lomg,dist,perim_len)
+	else:
+		perim_x,perim_y=hull_perimeter(x_above,y_above)
 
 	wl_list=[use_filts,filt_dict,uni_wl,uni_dwl]
 	
-	new_phx_dict,phx_mu,phx_wav,teff_list,logg_list,str_teff_list,str_logg_list=read_phoenix(phx_dir,mode,wl_list)
+	new_phx_dict,phx_mu,phx_wav,teff_list,logg_list,str_teff_list,str_logg_list=phoenix_grid(phx_dir,mode,wl_list)
 	if len(new_phx_dict) > len(phx_dict):
 		phx_dict = new_phx_dict
 	
@@ -192,7 +105,7 @@ def osm(p,data):
 	
 
 	if 'v' in mode:
-		vis_chi2,g_points=calc_vis(p,R_p,beta,dist,lomg,OMG,m,vis,vis_err,wl,u_l,v_l,u_m,v_m,uni_wl,g_scale,perim_x,perim_y,n_params,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list,cal,y_above,x_above,star,model,model_dir)
+		vis_chi2,g_points=calc_vis(p,R_p,beta,dist,lomg,OMG,m,vis,vis_err,wl,u_l,v_l,u_m,v_m,uni_wl,perim_x,perim_y,n_params,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list,cal,y_above,x_above,star,model,model_dir)
 	else:
 		vis_chi2=0.
 	if 'p' in mode:
@@ -218,6 +131,8 @@ def osm(p,data):
 	
 	if 'L' in mode:
 		L_bol,L_app=calc_Lbol(p,R,tht_R,T_eff,g,g_r,g_t,lg,dist,phx_mu,colat,phi,sin_colat,cos_colat,cos_phi,sin_inc,cos_inc,phx_dir,use_Z,tg_lists,phx_dict,phx_wav,mode,wl_list)
+		extras[0]=L_bol
+		extras[1]=L_app
 		if 'a' in mode:
 			mesa_dir='C:/Users/Jeremy/Dropbox/Python/Astars/MESA/History_Files/'
 			age_guess=0.05
@@ -258,11 +173,36 @@ def osm(p,data):
 	
 	if 'o' in mode:
 		print 'Chi^2: {} (V: {}, P: {}). Params: [{}, {}, {}, {}, {}]. Time: {} s'.format(chi2,vis_chi2,phot_chi2,R_e,vel,inc*180./np.pi,T_p,pa*180./np.pi-90.,minielapsed)
+		footprint=phoenix_cache_footprint()
+		print 'Phoenix models: {} ({} with full spectra), {:.1f} MB of {:.1f} MB'.format(footprint['models'],footprint['spectra'],
+			(footprint['spectra_bytes']+footprint['band_bytes'])/1048576.,footprint['budget']/1048576.)
 	return chi2,phx_dict,g_points,extras
 	#except:
 	#	print 'An error occured. Returning with high chi^2.'
 	#	return 1e8,phx_dict,0,[0.,0.,0.,0.,0.,0.,0.,0.,0.,0.,0.,0.]
 
+def phoenix_grid(phx_dir,mode,wl_list):
+	"""Gives back the same things as read_phoenix, but only actually reads the phoenix grid the first time it's called
+	for a given phoenix directory and set of bands (filter curves included, see band_key). After that it's kept in
+	phx_session for the rest of the run, so osm doesn't redo it for every model.
+	Inputs:
+	phx_dir
+		The directory the phoenix spectra are located in.
+	mode
+		The mode string (only whether there's a 'p' and/or a 'v' matters here)
+	wl_list
+		[use_filts,filt_dict,uni_wl,uni_dwl]
+	
+	Outputs:
+	Same as read_phoenix
+	"""
+	key=(phx_dir,'p' in mode,'v' in mode,band_key(wl_list))
+	if key not in phx_session:
+		phx_session[key]=read_phoenix(phx_dir,mode,wl_list)
+		for this_file in phx_session[key][0]:
+			phoenix_cache(this_file,phx_session[key][0],mode)	#The seed models count against phx_cache_bytes too
+	return phx_session[key]
+
 def read_phoenix(phx_dir,mode,wl_list):
 	"""Reads the phoenix model spectra and sets up phx_dict dictionary.
 	
@@ -307,10 +247,7 @@ def read_phoenix(phx_dir,mode,wl_list):
 		A list of the log of surface gravity values available in the phoenix model spectra as strings
 	"""
 	phx_file='Z-0.0/lte07000-4.00-0.0.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits' #An example file to get the dictionary started
-	hdulist = pyfits.open(phx_dir+phx_file) #Read phx_file
-	unfiltered = hdulist[0].data #The intensity array
-	phx_mu=hdulist[1].data #The mu array
-	hdulist.close()
+	unfiltered,phx_mu=open_phoenix(phx_dir+'Z-0.0/','lte07000-4.00-0.0.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits') #Read phx_file
 	
 	unfiltered=list(unfiltered)
 	unfiltered=np.array(unfiltered)
@@ -319,47 +256,27 @@ def read_phoenix(phx_dir,mode,wl_list):
 	phx_mu=np.concatenate((np.array([0.]),phx_mu))
 	phx_wav=(np.arange(len(unfiltered[-1]))+500.)*1e-8 #This defines the wavelength array
 	
-	use_filts=wl_list[0]
-	filt_dict=wl_list[1]
-	uni_wl=wl_list[2]
-	uni_dwl=wl_list[3]
-
-	phot_filtered=[]
-	if 'p' in mode:
-		for i in range(len(use_filts)):
-			inted=[]
-			for j in np.arange(len(phx_mu)-1)+1:
-				#non_inted is the filtered (i.e., had a filter response curve applied to it), non-integrated version of the intensity array 
-				not_inted=unfiltered[j-1,:]*filt_dict[use_filts[i]]/fwhm(phx_wav,filt_dict[use_filts[i]])/1e8
-				#not_inted_reduced is non_inted that only includes the non-zero bit of the sed
-				#inted.append(np.trapz(not_inted,x=phx_wav))
-				not_inted_reduced = not_inted[np.where(filt_dict[use_filts[i]] > 0)]
-				#inted is non_inted_reduced that has been integrated over wavelength
-				inted.append(do_phx_integrate(not_inted_reduced))
-			phot_filtered.append(inted)
-	
-	vis_filtered=[]
-	if 'v' in mode:
-		for i in range(len(uni_wl)):
-			inted=[]
-			the_filter=np.zeros(len(phx_wav))
-			for k in range(len(phx_wav)):
-				#This creates a top-hat function for the filter response curve of the visibility observations
-				if phx_wav[k]/100. > uni_wl[i]-uni_dwl[i]/2. and phx_wav[k]/100. <= uni_wl[i]+uni_dwl[i]/2.:
-					the_filter[k]=1.
-			for j in np.arange(len(phx_mu)-1)+1:
-				#non_inted is the filtered (i.e., had a filter response curve applied to it), non-integrated version of the intensity array 
-				not_inted=unfiltered[j-1,:]*the_filter/uni_dwl[i]
-				#inted is non_inted that has been integrated over wavelength
-				#inted.append(np.trapz(not_inted,x=phx_wav))
-				not_inted_reduced = not_inted[np.where(not_inted > 0)]
-				#inted is non_inted_reduced that has been integrated over wavelength
-				inted.append(do_phx_integrate(not_inted_reduced))
-			vis_filtered.append(inted)
+	phot_filtered,vis_filtered=filter_phoenix(unfiltered,phx_mu,phx_wav,mode,wl_list)
 
 	phx_dict={phx_file:[unfiltered,phot_filtered,vis_filtered]} #Create a dictionary with the data as a function of file name.
 	
 	#The rest of the function sets what models are available 
+	teff_list,logg_list,str_teff_list,str_logg_list=phoenix_tg_lists()
+	return phx_dict,phx_mu,phx_wav,teff_list,logg_list,str_teff_list,str_logg_list
+
+def phoenix_tg_lists():
+	"""Lists the T_eff and log(g) values of the phoenix grid.
+	
+	Outputs:
+	teff_list
+		A list of the effective temperature values available in the phoenix model spectra
+	logg_list
+		A list of the log of surface gravity values available in the phoenix model spectra
+	str_teff_list
+		A list of the effective temperature values available in the phoenix model spectra as strings
+	str_logg_list
+		A list of the log of surface gravity values available in the phoenix model spectra as strings
+	"""
 	str_teff_list=[]
 	str_logg_list=[]
 	
@@ -380,7 +297,7 @@ def read_phoenix(phx_dir,mode,wl_list):
 			str_logg_list.append('+'+str(logg_list[i])+'0')
 		else:
 			str_logg_list.append('-'+str(logg_list[i])+'0')
-	return phx_dict,phx_mu,phx_wav,teff_list,logg_list,str_teff_list,str_logg_list
+	return teff_list,logg_list,str_teff_list,str_logg_list
 
 def extract_phoenix_full(teff,logg,mu,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list):
 	"""Constructs an intensity spectrum based on the effective temperature, surface gravity, and angle of observation
@@ -412,9 +329,7 @@ def extract_phoenix_full(teff,logg,mu,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx
 	"""
 	
 	#print teff,logg
-	phx_dir=phx_dir+use_Z+'/'
-	path_list=os.listdir(phx_dir)
-	ftp_dir='ftp://phoenix.astro.physik.uni-goettingen.de/SpecIntFITS/PHOENIX-ACES-AGSS-COND-SPECINT-2011/'+use_Z+'/'
+	catalog=phoenix_catalog(phx_dir,use_Z,tg_lists,mode,wl_list)
 	
 	teff_list=np.array(tg_lists[0])
 	logg_list=np.array(tg_lists[1])
@@ -453,49 +368,29 @@ def extract_phoenix_full(teff,logg,mu,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx
 	hh_file='lte'+thi_str+ghi_str+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
 
 	#Low Temperature, Low Gravity
-	if ll_file in phx_dict:
-		ll_arr = phx_dict[ll_file][0]
-	elif ll_file in path_list:
-		ll_arr=read_this_phoenix(ll_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[0]
-	else:
-		ll_arr=read_this_phoenix_ftp(ll_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[0]
+	ll_arr=load_phoenix(ll_file,phx_dict,catalog,phx_mu,phx_wav,mode,wl_list)[0]
 	#Low Temperature, High Gravity
-	if lh_file in phx_dict:
-		lh_arr = phx_dict[lh_file][0]
-	elif lh_file in path_list:
-		lh_arr=read_this_phoenix(lh_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[0]
-	else:
-		lh_arr=read_this_phoenix_ftp(lh_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[0]
+	lh_arr=load_phoenix(lh_file,phx_dict,catalog,phx_mu,phx_wav,mode,wl_list)[0]
 	#High Temperature, Low Gravity
-	if hl_file in phx_dict:
-		hl_arr = phx_dict[hl_file][0]
-	elif hl_file in path_list:
-		hl_arr=read_this_phoenix(hl_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[0]
-	else:
-		hl_arr=read_this_phoenix_ftp(hl_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[0]
+	hl_arr=load_phoenix(hl_file,phx_dict,catalog,phx_mu,phx_wav,mode,wl_list)[0]
 	#High Temperature, High Gravity
-	if hh_file in phx_dict:
-		hh_arr = phx_dict[hh_file][0]
-	elif hh_file in path_list:
-		hh_arr=read_this_phoenix(hh_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[0]
-	else:
-		hh_arr=read_this_phoenix_ftp(hh_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[0]
+	hh_arr=load_phoenix(hh_file,phx_dict,catalog,phx_mu,phx_wav,mode,wl_list)[0]
 
 	if mlo != mhi:
 		if mlo == 0.:
-			ll=ll_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
-			lh=lh_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
-			hl=hl_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
-			hh=hh_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
+			ll=phoenix_rows(ll_arr,mhi_ind-1)*(mu-mlo)/(mhi-mlo)
+			lh=phoenix_rows(lh_arr,mhi_ind-1)*(mu-mlo)/(mhi-mlo)
+			hl=phoenix_rows(hl_arr,mhi_ind-1)*(mu-mlo)/(mhi-mlo)
+			hh=phoenix_rows(hh_arr,mhi_ind-1)*(mu-mlo)/(mhi-mlo)
 			ll=ll[0]
 			lh=lh[0]
 			hl=hl[0]
 			hh=hh[0]			
 		else:
-			ll=ll_arr[mlo_ind-1]+(ll_arr[mhi_ind-1]-ll_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
-			lh=lh_arr[mlo_ind-1]+(lh_arr[mhi_ind-1]-lh_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
-			hl=hl_arr[mlo_ind-1]+(hl_arr[mhi_ind-1]-hl_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
-			hh=hh_arr[mlo_ind-1]+(hh_arr[mhi_ind-1]-hh_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
+			ll=phoenix_rows(ll_arr,mlo_ind-1)+(phoenix_rows(ll_arr,mhi_ind-1)-phoenix_rows(ll_arr,mlo_ind-1))*(mu-mlo)/(mhi-mlo)
+			lh=phoenix_rows(lh_arr,mlo_ind-1)+(phoenix_rows(lh_arr,mhi_ind-1)-phoenix_rows(lh_arr,mlo_ind-1))*(mu-mlo)/(mhi-mlo)
+			hl=phoenix_rows(hl_arr,mlo_ind-1)+(phoenix_rows(hl_arr,mhi_ind-1)-phoenix_rows(hl_arr,mlo_ind-1))*(mu-mlo)/(mhi-mlo)
+			hh=phoenix_rows(hh_arr,mlo_ind-1)+(phoenix_rows(hh_arr,mhi_ind-1)-phoenix_rows(hh_arr,mlo_ind-1))*(mu-mlo)/(mhi-mlo)
 			ll=ll[0]
 			lh=lh[0]
 			hl=hl[0]
@@ -507,13 +402,13 @@ def extract_phoenix_full(teff,logg,mu,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx
 			hl=np.zeros(len(phx_wav))
 			hh=np.zeros(len(phx_wav))
 		else:
-			ll=ll_arr[mlo_ind-1]
+			ll=phoenix_rows(ll_arr,mlo_ind-1)
 			ll=ll[0]
-			lh=lh_arr[mlo_ind-1]
+			lh=phoenix_rows(lh_arr,mlo_ind-1)
 			lh=lh[0]
-			hl=hl_arr[mlo_ind-1]
+			hl=phoenix_rows(hl_arr,mlo_ind-1)
 			hl=hl[0]
-			hh=hh_arr[mlo_ind-1]
+			hh=phoenix_rows(hh_arr,mlo_ind-1)
 			hh=hh[0]
 	
 	if thi != tlo and ghi != glo:
@@ -525,8 +420,10 @@ def extract_phoenix_full(teff,logg,mu,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx
 	elif thi == tlo and ghi == glo:
 		interpolated_flux=ll
 	return np.array(interpolated_flux)
-def extract_phoenix_phot(teff,logg,mu,filt,use_filts,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list):
-	"""Constructs an intensity spectrum based on the effective temperature, surface gravity, and angle of observation
+def extract_phoenix_pca(teff,logg,mu,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list):
+	"""Same as extract_phoenix_full, but with the compressed phoenix grid (see pca_phoenix): gives back the coefficients
+	of the spectrum on the basis spectra instead of the spectrum. The spectrum is np.dot(coefficients,pca['basis']).
+	Models that aren't in the compressed grid are read in and projected onto the basis the first time they're needed.
 	
 	Inputs:
 	teff
@@ -536,15 +433,10 @@ def extract_phoenix_phot(teff,logg,mu,filt,use_filts,phx_dir,use_Z,tg_lists,phx_
 	mu
 		The cosine of the angle between the normal and the line of sight of 
 		the observation of the spectrum to be extracted	
-	filt
-		The filter for which the photometry are to be extracted
-	use_filts
-		The list of all filters used for the photometry
 	phx_dir
 		The directory the phoenix spectra are located in.
 	use_Z
-		The metallicity used for desired phoenix model spectra. This is used in determining
-		the ftp path for using  
+		The metallicity used for desired phoenix model spectra.
 	tg_lists
 		A list of lists with teff_list, logg_list, str_teff_list, and str_logg_list
 	phx_mu
@@ -553,250 +445,595 @@ def extract_phoenix_phot(teff,logg,mu,filt,use_filts,phx_dir,use_Z,tg_lists,phx_
 		A dictionary with all the saved phoenix spectra in it
 	
 	Outputs:
-	interpolated_flux
-		An array with a spectrum for the given T_eff, log(g), and mu.
-	
+	interpolated_coef
+		An array with the basis coefficients of the spectrum for the given T_eff, log(g), and mu.
 	"""
+	pca=open_phoenix_pca(phx_dir+use_Z+'/')
+	tlo,thi,tf=grid_bracket(tg_lists[0],np.array([teff]))
+	glo,ghi,gf=grid_bracket(tg_lists[1],np.array([logg]))
+	mlo,mhi,mf=grid_bracket(phx_mu,np.array([max(mu,0.)]))
+	corners=[]
+	for it in [tlo[0],thi[0]]:
+		for ig in [glo[0],ghi[0]]:
+			this_file='lte'+tg_lists[2][it]+tg_lists[3][ig]+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
+			if this_file not in pca['coef']:
+				catalog=phoenix_catalog(phx_dir,use_Z,tg_lists,'L',wl_list)
+				this_arr=load_phoenix(this_file,phx_dict,catalog,phx_mu,phx_wav,'L'+mode.replace('c',''),wl_list)[0]
+				this_arr=phoenix_rows(this_arr,slice(None))
+				pca['coef'][this_file]=np.concatenate((np.zeros((1,len(pca['basis']))),np.dot(np.asarray(this_arr,dtype=float),pca['basis'].T)))
+			this_coef=pca['coef'][this_file]
+			corners.append(this_coef[mlo[0]]+(this_coef[mhi[0]]-this_coef[mlo[0]])*mf[0])
+	ll,lh,hl,hh=corners
+	return (ll*(1.-gf[0])+lh*gf[0])*(1.-tf[0])+(hl*(1.-gf[0])+hh*gf[0])*tf[0]
+
+def hemisphere_flux(this_arr,phx_mu,phx_wav):
+	"""Integrates the intensities of a phoenix model over mu and wavelength the way calc_Lbol does:
+	2 pi int(int(mu*I dmu) dlambda), leaving out the first wavelength.
+	Inputs:
+	this_arr
+		The (mu x wavelength) intensities, as they're stored in phx_dict
+	phx_mu
+		The list of mu values used by phoenix spectra (with 0 at the front)
+	phx_wav
+		The wavelengths of the phoenix spectra
 	
-	filt_ind=np.arange(len(use_filts))[(np.array(use_filts) == filt).nonzero()][0]
-	
-	phx_dir=phx_dir+use_Z+'/'
-	path_list=os.listdir(phx_dir)
-	ftp_dir='ftp://phoenix.astro.physik.uni-goettingen.de/SpecIntFITS/PHOENIX-ACES-AGSS-COND-SPECINT-2011/'+use_Z+'/'
-	
-	teff_list=np.array(tg_lists[0])
-	logg_list=np.array(tg_lists[1])
-	str_teff_list=np.array(tg_lists[2])
-	str_logg_list=np.array(tg_lists[3])
+	Outputs:
+	I_bol
+		The integrated intensity
+	"""
 	phx_mu=np.array(phx_mu)
+	mu_I=np.asarray(phoenix_rows(this_arr,slice(None)),dtype=float)*phx_mu[1:,None]
+	mu_I=np.concatenate((np.zeros((1,np.shape(mu_I)[1])),mu_I))	#The intensity at mu=0 is 0
+	I_lam=np.trapz(mu_I,x=phx_mu,axis=0)
+	I_lam[0]=0.
+	return np.trapz(I_lam,x=phx_wav)*2.*np.pi
+
+def mu_intensity(this_arr,phx_wav):
+	"""Integrates the intensities of a phoenix model over wavelength at each mu, the way calc_Lbol does for L_app.
+	Inputs:
+	this_arr
+		The (mu x wavelength) intensities, as they're stored in phx_dict
+	phx_wav
+		The wavelengths of the phoenix spectra
 	
-	gett=teff_list[np.where(teff_list >= round(teff,4))]
-	lett=teff_list[np.where(teff_list <= round(teff,4))]
-	tlo=max(lett)
-	thi=min(gett)
-	gegg=logg_list[np.where(logg_list >= round(logg,4))]
-	legg=logg_list[np.where(logg_list <= round(logg,4))]
-	glo=max(legg)
-	ghi=min(gegg)
-	gemm=phx_mu[np.where(phx_mu >= round(mu,4))]
-	lemm=phx_mu[np.where(phx_mu <= round(mu,4))]
-	if mu <1e-10:
-		mlo=0.
-		mlo_ind = 0
-	else:
-		mlo=max(lemm)
-		mlo_ind=np.arange(len(phx_mu))[np.where(phx_mu == mlo)][0]
-	mhi=min(gemm)
-	mhi_ind=np.arange(len(phx_mu))[np.where(phx_mu == mhi)][0]
-
-	tlo_str=str_teff_list[np.where(teff_list == tlo)][0]
-	glo_str=str_logg_list[np.where(logg_list == glo)][0]
-	thi_str=str_teff_list[np.where(teff_list == thi)][0]
-	ghi_str=str_logg_list[np.where(logg_list == ghi)][0]
+	Outputs:
+	I_mu
+		The integrated intensity at each mu, with a 0 at the front for mu=0 (like phx_mu)
+	"""
+	I_mu=np.trapz(np.asarray(phoenix_rows(this_arr,slice(None)),dtype=float),x=phx_wav,axis=1)
+	return np.concatenate((np.zeros(1),I_mu))
 
-	#The four files representing the T_eff and log(g) on the grid just below and above what we want
-	ll_file='lte'+tlo_str+glo_str+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
-	lh_file='lte'+tlo_str+ghi_str+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
-	hl_file='lte'+thi_str+glo_str+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
-	hh_file='lte'+thi_str+ghi_str+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
-	
-	
-	#Low Temperature, Low Gravity
-	if ll_file in phx_dict:
-		ll_arr = phx_dict[ll_file][1][filt_ind]
-	elif ll_file in path_list:
-		ll_arr=read_this_phoenix(ll_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[1][filt_ind]
-	else:
-		ll_arr=read_this_phoenix_ftp(ll_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[1][filt_ind]
-	#Low Temperature, High Gravity
-	if lh_file in phx_dict:
-		lh_arr = phx_dict[lh_file][1][filt_ind]
-	elif lh_file in path_list:
-		lh_arr=read_this_phoenix(lh_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[1][filt_ind]
-	else:
-		lh_arr=read_this_phoenix_ftp(lh_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[1][filt_ind]
-	#High Temperature, Low Gravity
-	if hl_file in phx_dict:
-		hl_arr = phx_dict[hl_file][1][filt_ind]
-	elif hl_file in path_list:
-		hl_arr=read_this_phoenix(hl_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[1][filt_ind]
-	else:
-		hl_arr=read_this_phoenix_ftp(hl_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[1][filt_ind]
-	#High Temperature, High Gravity
-	if hh_file in phx_dict:
-		hh_arr = phx_dict[hh_file][1][filt_ind]
-	elif hh_file in path_list:
-		hh_arr=read_this_phoenix(hh_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[1][filt_ind]
-	else:
-		hh_arr=read_this_phoenix_ftp(hh_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[1][filt_ind]
-	
+def precompute_bol(phx_dir,use_Z):
+	"""Works out the integrated intensities (see hemisphere_flux and mu_intensity) of every phoenix model available
+	locally and saves them next to the grid, where phoenix_bol finds them.
+	Inputs:
+	phx_dir
+		The directory the phoenix spectra are located in (without the metallicity)
+	use_Z
+		The metallicity of the phoenix model spectra
 	
-	if mlo != mhi:
-		if mlo == 0.:
-			ll=ll_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
-			lh=lh_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
-			hl=hl_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
-			hh=hh_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
-		else:
-			ll=ll_arr[mlo_ind-1]+(ll_arr[mhi_ind-1]-ll_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
-			lh=lh_arr[mlo_ind-1]+(lh_arr[mhi_ind-1]-lh_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
-			hl=hl_arr[mlo_ind-1]+(hl_arr[mhi_ind-1]-hl_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
-			hh=hh_arr[mlo_ind-1]+(hh_arr[mhi_ind-1]-hh_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
-	else:
-		if mlo == 0.:
-			ll=zeros(len(phx_wav))
-			lh=zeros(len(phx_wav))
-			hl=zeros(len(phx_wav))
-			hh=zeros(len(phx_wav))
-		else:
-			ll=ll_arr[mlo_ind-1]
-			lh=lh_arr[mlo_ind-1]
-			hl=hl_arr[mlo_ind-1]
-			hh=hh_arr[mlo_ind-1]
-			
-	if thi != tlo and ghi != glo:
-		interpolated_flux=ll/(thi-tlo)/(ghi-glo)*(thi-teff)*(ghi-logg)+lh/(thi-tlo)/(ghi-glo)*(thi-teff)*(logg-glo)+hl/(thi-tlo)/(ghi-glo)*(teff-tlo)*(ghi-logg)+hh/(thi-tlo)/(ghi-glo)*(teff-tlo)*(logg-glo)
-	elif thi != tlo and ghi == glo:
-		interpolated_flux=ll+(hl-ll)*(teff-tlo)/(thi-tlo)
-	elif thi == tlo and ghi != glo:		
-		interpolated_flux=ll+(lh-ll)*(logg-glo)/(ghi-glo)
-	elif thi == tlo and ghi == glo:
-		interpolated_flux=ll
+	Outputs:
+	bol_file
+		The name of the file that was written
+	"""
+	fits_dir=phx_dir+use_Z+'/'
+	bol_file=fits_dir.rstrip('/')+'_bol.npz'
+	files=[f for f in set(phoenix_files(fits_dir)) if f.startswith('lte') and f.endswith('.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits')]
+	files.sort(key=lambda f: (int(f[3:8]),abs(float(f[8:13]))))
+	flux=[]
+	mu_int=[]
+	for i in range(len(files)):
+		print 'Integrating {} ({} of {})'.format(files[i],i+1,len(files))
+		this_arr,this_mu=open_phoenix(fits_dir,files[i])
+		phx_mu=np.concatenate((np.array([0.]),this_mu))
+		phx_wav=(np.arange(np.shape(this_arr)[1])+500.)*1e-8
+		flux.append(hemisphere_flux(this_arr,phx_mu,phx_wav))
+		mu_int.append(mu_intensity(this_arr,phx_wav))
+	np.savez(bol_file,files=np.array(files),flux=np.array(flux),mu_int=np.array(mu_int))
+	phx_bols.pop(fits_dir,None)
+	return bol_file
+
+def phoenix_bol_cell(it,ig,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list):
+	"""Gets the integrated intensities of the phoenix model at a point of the T_eff/log(g) grid. They come from
+	precompute_bol if it's been run, and otherwise get worked out (and kept in phx_bols) the first time the model is
+	needed.
+	Inputs:
+	it, ig
+		The indices of the model's T_eff and log(g) in tg_lists
 	
-	return interpolated_flux
-
-def extract_phoenix_vis(teff,logg,mu,wl_ind,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list):
-	"""Constructs an intensity spectrum based on the effective temperature, surface gravity, and angle of observation
+	Outputs:
+	flux
+		The hemispheric flux (see hemisphere_flux)
+	I_mu
+		The intensity at each of phx_mu integrated over wavelength (see mu_intensity)
+	"""
+	fits_dir=phx_dir+use_Z+'/'
+	if fits_dir not in phx_bols:
+		phx_bols[fits_dir]=dict()
+		bol_file=fits_dir.rstrip('/')+'_bol.npz'
+		if phx_tables and os.path.isfile(bol_file):
+			data=np.load(bol_file)
+			for i in range(len(data['files'])):
+				phx_bols[fits_dir][str(data['files'][i])]=(float(data['flux'][i]),data['mu_int'][i])
+	table=phx_bols[fits_dir]
+	this_file='lte'+tg_lists[2][it]+tg_lists[3][ig]+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
+	if this_file not in table:
+		catalog=phoenix_catalog(phx_dir,use_Z,tg_lists,'L',wl_list)
+		this_arr=load_phoenix(this_file,phx_dict,catalog,phx_mu,phx_wav,'L'+mode.replace('c',''),wl_list)[0]
+		table[this_file]=(hemisphere_flux(this_arr,phx_mu,phx_wav),mu_intensity(this_arr,phx_wav))
+	return table[this_file]
+
+def phoenix_bol(teff,logg,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list):
+	"""Interpolates the integrated intensity (see hemisphere_flux) at a set of points. Since the integral is linear in the
+	spectrum, this gives the same thing as interpolating the spectra (extract_phoenix_full) and integrating them.
+	Inputs:
+	teff
+		Array of the effective temperatures of the points
+	logg
+		Array of the log of the surface gravity of the points
+	phx_dir
+		The directory the phoenix spectra are located in.
+	use_Z
+		The metallicity used for desired phoenix model spectra.
+	tg_lists
+		A list of lists with teff_list, logg_list, str_teff_list, and str_logg_list
+	phx_mu
+		The list of mu values used by phoenix spectra (with 0 at the front)
+	phx_dict
+		A dictionary with all the saved phoenix spectra in it
 	
+	Outputs:
+	I_bol
+		Array of the integrated intensities
+	"""
+	tlo,thi,tf=grid_bracket(tg_lists[0],np.asarray(teff))
+	glo,ghi,gf=grid_bracket(tg_lists[1],np.asarray(logg))
+	I_bol=np.zeros(len(tlo))
+	for i in range(len(tlo)):
+		ll=phoenix_bol_cell(tlo[i],glo[i],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)[0]
+		lh=phoenix_bol_cell(tlo[i],ghi[i],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)[0]
+		hl=phoenix_bol_cell(thi[i],glo[i],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)[0]
+		hh=phoenix_bol_cell(thi[i],ghi[i],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)[0]
+		I_bol[i]=(ll*(1.-gf[i])+lh*gf[i])*(1.-tf[i])+(hl*(1.-gf[i])+hh*gf[i])*tf[i]
+	return I_bol
+
+def phoenix_bol_mu(teff,logg,mu,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list):
+	"""Interpolates the intensity integrated over wavelength (see mu_intensity) at a set of points. This is the integral
+	of what extract_phoenix_full gives back, without handling any spectra.
 	Inputs:
 	teff
-		The effective temperature of the spectrum to be extracted
+		Array of the effective temperatures of the points
 	logg
-		The log of the surface gravity of the spectrum to be extracted
+		Array of the log of the surface gravity of the points
 	mu
-		The cosine of the angle between the normal and the line of sight of 
-		the observation of the spectrum to be extracted	
-	filt
-		The filter for which the photometry are to be extracted
-	wl_ind
-		The index of the wavelength of the visibility measurement
+		Array of the cosines of the angles between the normals and the line of sight
 	phx_dir
 		The directory the phoenix spectra are located in.
 	use_Z
-		The metallicity used for desired phoenix model spectra. This is used in determining
-		the ftp path for using  
+		The metallicity used for desired phoenix model spectra.
 	tg_lists
 		A list of lists with teff_list, logg_list, str_teff_list, and str_logg_list
 	phx_mu
-		The list of mu values used by phoenix spectra
+		The list of mu values used by phoenix spectra (with 0 at the front)
 	phx_dict
 		A dictionary with all the saved phoenix spectra in it
 	
 	Outputs:
-	interpolated_flux
-		An array with a spectrum for the given T_eff, log(g), and mu.
+	I_int
+		Array of the integrated intensities
+	"""
+	tlo,thi,tf=grid_bracket(tg_lists[0],np.asarray(teff))
+	glo,ghi,gf=grid_bracket(tg_lists[1],np.asarray(logg))
+	mlo,mhi,mf=grid_bracket(phx_mu,np.maximum(mu,0.))
+	if len(tlo) == 0:
+		return np.zeros(0)
+	I_mu=dict()
+	for cell in set(zip(tlo,glo)+zip(tlo,ghi)+zip(thi,glo)+zip(thi,ghi)):
+		I_mu[cell]=phoenix_bol_cell(cell[0],cell[1],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)[1]
+	points=np.arange(len(tlo))
+	corners=[]
+	for it,ig in [(tlo,glo),(tlo,ghi),(thi,glo),(thi,ghi)]:
+		rows=np.array([I_mu[cell] for cell in zip(it,ig)])
+		corners.append(rows[points,mlo]+(rows[points,mhi]-rows[points,mlo])*mf)
+	ll,lh,hl,hh=corners
+	return (ll*(1.-gf)+lh*gf)*(1.-tf)+(hl*(1.-gf)+hh*gf)*tf
+
+def load_phoenix(this_file,phx_dict,catalog,phx_mu,phx_wav,mode,wl_list):
+	"""Gets the phx_dict entry for a phoenix model, reading it from the local grid (or fetching it from phx_source into the
+	local grid if it isn't there) if it hasn't been read in yet. Models that can't be had from phx_source are marked
+	missing in the catalog, so they're only tried once.
+	Inputs:
+	this_file
+		The name of the phoenix .fits file
+	phx_dict
+		A dictionary with all the saved phoenix spectra in it
+	catalog
+		The catalog of the phoenix grid, from phoenix_catalog
 	
+	Outputs:
+	this_file_entry
+		The entry this file has in phx_dict
 	"""
-	phx_dir=phx_dir+use_Z+'/'
-	path_list=os.listdir(phx_dir)
-	ftp_dir='ftp://phoenix.astro.physik.uni-goettingen.de/SpecIntFITS/PHOENIX-ACES-AGSS-COND-SPECINT-2011/'+use_Z+'/'
+	if phx_dict.get(this_file) and (phx_dict[this_file][0] is not None or not full_spectra(mode)):
+		return phoenix_cache(this_file,phx_dict,mode)
+	if this_file in phx_dict:
+		phx_lru.pop(id(phx_dict[this_file]),None)	#It's getting read again, into a new entry
+	if this_file in catalog['local']:
+		read_this_phoenix(this_file,phx_dict,catalog['dir'],phx_mu,phx_wav,mode,wl_list)
+		return phoenix_cache(this_file,phx_dict,mode)
+	if this_file in catalog['missing']:
+		raise IOError('{} is not available locally or from {}'.format(this_file,catalog['source']))
+	try:
+		if phx_mirror:
+			print '---Grabbing this file from {}: {}'.format(catalog['source'],this_file)
+			fetch_phoenix(this_file,catalog['source'],catalog['dir'])
+		else:
+			read_this_phoenix_ftp(this_file,phx_dict,catalog['source'],phx_mu,phx_wav,mode,wl_list)
+			return phoenix_cache(this_file,phx_dict,mode)
+	except IOError:
+		catalog['remote'].discard(this_file)
+		catalog['missing'].add(this_file)
+		raise
+	catalog['remote'].discard(this_file)
+	catalog['local'].add(this_file)
+	read_this_phoenix(this_file,phx_dict,catalog['dir'],phx_mu,phx_wav,mode,wl_list)
+	return phoenix_cache(this_file,phx_dict,mode)
+
+def phoenix_cache(this_file,phx_dict,mode):
+	"""Keeps track of how recently each model in phx_dict was used and keeps them all within phx_cache_bytes.
+	The full spectrum of a model (phx_dict[this_file][0]) is only kept if luminosities ('L') or plots ('P') need it.
+	When the models take up too much memory, the least recently used full spectra get dropped first (the band
+	integrals are kept, so the model doesn't have to be read again unless its full spectrum is needed), then the least
+	recently used models altogether. The model just used is never dropped. The budget covers every model loaded in
+	the run, whichever phx_dict it's in (the one from phoenix_grid included), and phx_lru only holds on to the models'
+	entries, not the dictionaries. A model that's dropped altogether is left in its phx_dict as an empty entry, which
+	load_phoenix reads again if it's needed.
+	Inputs:
+	this_file
+		The phoenix .fits file that was just used
+	phx_dict
+		A dictionary with all the saved phoenix spectra in it
+	mode
+		The mode string
 	
-	teff_list=np.array(tg_lists[0])
-	logg_list=np.array(tg_lists[1])
-	str_teff_list=np.array(tg_lists[2])
-	str_logg_list=np.array(tg_lists[3])
-	phx_mu=np.array(phx_mu)
+	Outputs:
+	this_file_entry
+		The entry this file has in phx_dict
+	"""
+	entry=phx_dict[this_file]
+	key=id(entry)	#Each record holds its entry, so the id can't be reused while it's in phx_lru
+	if key in phx_lru:
+		phx_lru[key]=phx_lru.pop(key)
+		return entry
+	if not full_spectra(mode):
+		entry[0]=None
+	entry[1]=np.array(entry[1],dtype=band_dtype())
+	entry[2]=np.array(entry[2],dtype=band_dtype())
+	raw_bytes=0
+	if entry[0] is not None:
+		entry[0]=store_spectra(entry[0])
+		if isinstance(entry[0],tuple):
+			raw_bytes=entry[0][0].nbytes+entry[0][1].nbytes
+		else:
+			raw_bytes=entry[0].nbytes
+	phx_lru[key]=[entry,raw_bytes,entry[1].nbytes+entry[2].nbytes]
+	
+	total=sum(record[1]+record[2] for record in phx_lru.itervalues())
+	if total > phx_cache_bytes:
+		for other,record in phx_lru.items():	#Least recently used first
+			if total <= phx_cache_bytes: break
+			if other != key and record[1] > 0:
+				record[0][0]=None
+				total-=record[1]
+				record[1]=0
+		for other,record in phx_lru.items():
+			if total <= phx_cache_bytes: break
+			if other != key:
+				del record[0][:]
+				del phx_lru[other]
+				total-=record[2]
+	return entry
+
+def band_dtype():
+	"""The type the band integrated intensities are stored as (see phx_storage)"""
+	return {'as read':np.float64,'float32':np.float32,'float16':np.float32}[phx_storage]
+
+def input_model(input_file,mode):
+	"""Reads in the data a star's input file points to and puts together the model in it and the data list osm takes,
+	for the scripts that run one model a few different ways (storage_report.py, symmetry_report.py).
+	Inputs:
+	input_file
+		The input file (see read_input)
+	mode
+		The mode string to start from. 'v', 'p', 'z', and 'r' get added to it as the input file asks.
 	
-	gett=teff_list[np.where(teff_list >= round(teff,4))]
-	lett=teff_list[np.where(teff_list <= round(teff,4))]
-	tlo=max(lett)
-	thi=min(gett)
-	gegg=logg_list[np.where(logg_list >= round(logg,4))]
-	legg=logg_list[np.where(logg_list <= round(logg,4))]
-	glo=max(legg)
-	ghi=min(gegg)
-	gemm=phx_mu[np.where(phx_mu >= round(mu,4))]
-	lemm=phx_mu[np.where(phx_mu <= round(mu,4))]
-	if mu <1e-10:
-		mlo=0.
-		mlo_ind = 0
-	else:
-		mlo=max(lemm)
-		mlo_ind=np.arange(len(phx_mu))[np.where(phx_mu == mlo)][0]
-	mhi=min(gemm)
-	mhi_ind=np.arange(len(phx_mu))[np.where(phx_mu == mhi)][0]
-
-	tlo_str=str_teff_list[np.where(teff_list == tlo)][0]
-	glo_str=str_logg_list[np.where(logg_list == glo)][0]
-	thi_str=str_teff_list[np.where(teff_list == thi)][0]
-	ghi_str=str_logg_list[np.where(logg_list == ghi)][0]
-
-	ll_file='lte'+tlo_str+glo_str+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
-	lh_file='lte'+tlo_str+ghi_str+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
-	hl_file='lte'+thi_str+glo_str+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
-	hh_file='lte'+thi_str+ghi_str+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
+	Outputs:
+	r
+		[R_e,vel,inc,T_p,pa] of the model in the input file
+	data
+		The data list osm takes
+	"""
+	input_dict=read_input(input_file)
+	
+	star=input_dict['Star']
+	model=input_dict['Model']
+	star_dir=input_dict['Star Directory']+star+'/'
+	model_dir=star_dir+model+'/'
+	phx_dir=input_dict['Atmo Directory']
+	filt_dir=input_dict['Filter Directory']
+	use_Z='Z-0.0'
+	vis_inp=star_dir+star+'.vis'	#Visibility input file
+	phot_inp=star_dir+star+'.phot'	#Photometry input file
+	if input_dict['Calc Vis'] == 'Y': mode+='v'
+	if input_dict['Calc Phot'] == 'Y': mode+='p'
+	if input_dict['Gravity Darkening'] == 'vZ': mode+='z'
+	if input_dict['Gravity Darkening'] == 'ELR': mode+='r'
+	
+	wl,wlerr,vis,vis_err,u_m,v_m,u_l,v_l,cal=read_vis(vis_inp)
+	phot_data,use_filts=read_phot(phot_inp)
+	cwl,zpf=read_cwlzpf(filt_dir+'cwlzpf.txt')
+	wav=get_phoenix_wave(phx_dir)
+	filt_dict=read_filters(use_filts,filt_dir,cwl,wav)
+	
+	colat_len=20
+	phi_len=30
+	
+	uni_wl=[]	#What are all the unique wavlengths in this observation
+	uni_dwl=[] #The fwhm of the unique wavelengths observed
+	for i in range(len(wl)):
+		if wl[i] not in uni_wl:
+			uni_wl.append(wl[i])
+			uni_dwl.append(wlerr[i])
+	
+	base_chi2=1e8
+	m=float(input_dict['Mass'])
+	beta=0.
+	dist=1000./float(input_dict['Parallax'])
+	g_scale=1.
+	
+	r=[float(input_dict['Equatorial Radius']),float(input_dict['Equatorial Velocity']),float(input_dict['Inclination'])*np.pi/180.,
+		float(input_dict['Polar Temperature']),float(input_dict['Position Angle'])*np.pi/180.+np.pi/2.]
+	return r,[base_chi2,m,beta,dist,vis,vis_err,phot_data,wl,u_l,v_l,u_m,v_m,uni_wl,uni_dwl,g_scale,phx_dir,use_Z,use_filts,filt_dict,zpf,cwl,dict(),colat_len,phi_len,cal,star,model,model_dir,mode]
+
+def storage_report(p,data,storages=['as read','float32','float16']):
+	"""Runs one model with the phoenix models stored at each precision in storages (see phx_storage) and prints how much
+	chi^2 and the luminosities change compared to the first one, and how much memory the models took. Every cache that
+	holds something worked out from the stored models is cleared before each run, and the precomputed tables are left
+	out (see phx_tables), so each run really uses its own precision.
+	Inputs:
+	p
+		[R_e,vel,inc,T_p,pa] of the reference model
+	data
+		The data list osm takes. Luminosities are only compared if 'L' is in the mode.
+	storages
+		The precisions to compare
+	
+	Outputs:
+	results
+		Dictionary with [chi2,L_bol,L_app,bytes] for each precision
+	"""
+	global phx_storage,phx_tables
+	old_storage=phx_storage
+	old_tables=phx_tables
+	phx_tables=False
+	caches=[phx_lru,phx_session,phx_bands,phx_bols,phx_pcas,phx_catalogs]
+	results=dict()
+	print '{:>8} {:>22} {:>10} {:>12} {:>10} {:>12} {:>10} {:>10}'.format('storage','chi2','d(chi2)','L_bol','dL_bol/L','L_app','dL_app/L','MB')
+	for storage in storages:
+		phx_storage=storage
+		for cache in caches:
+			cache.clear()
+		this_data=list(data)
+		this_data[21]=dict()	#Fresh phx_dict
+		chi2,phx_dict,g_points,extras=osm(p,this_data)
+		footprint=phoenix_cache_footprint()
+		results[storage]=[chi2,extras[0],extras[1],footprint['spectra_bytes']+footprint['band_bytes']]
+		ref=results[storages[0]]
+		print '{:>8} {:>22.15g} {:>10.2e} {:>12.6g} {:>10.2e} {:>12.6g} {:>10.2e} {:>10.2f}'.format(storage,chi2,chi2-ref[0],extras[0],
+			(extras[0]-ref[1])/ref[1] if ref[1] != 0. else 0.,extras[1],(extras[1]-ref[2])/ref[2] if ref[2] != 0. else 0.,results[storage][3]/1048576.)
+	phx_storage=old_storage
+	phx_tables=old_tables
+	for cache in caches:
+		cache.clear()
+	return results
+
+def symmetry_report(p,data,tol=1e-12):
+	"""Runs one model with the surface integrals done over the whole star and over half of it (see use_symmetry, phi_fold
+	and colat_fold), and prints how much chi^2 and the luminosities change and how long each took. They should agree to
+	rounding, so a ValueError gets raised if any of them differ by more than tol (relative).
+	Inputs:
+	p
+		[R_e,vel,inc,T_p,pa] of the model
+	data
+		The data list osm takes. Luminosities are only compared if 'L' is in the mode.
+	tol
+		The largest relative difference allowed
+	
+	Outputs:
+	results
+		Dictionary with [chi2,L_bol,L_app,seconds] with the symmetry off (False) and on (True)
+	"""
+	global use_symmetry
+	old_symmetry=use_symmetry
+	results=dict()
+	print '{:>8} {:>22} {:>10} {:>12} {:>10} {:>12} {:>10} {:>8}'.format('symmetry','chi2','d(chi2)','L_bol','dL_bol/L','L_app','dL_app/L','s')
+	phx_dict=dict()
+	for symmetry in [False,True]:
+		use_symmetry=symmetry
+		this_data=list(data)
+		this_data[21]=phx_dict	#Shared, so the second run doesn't pay for reading models
+		chi2,phx_dict,g_points,extras=osm(p,this_data)	#Once to read in the models
+		start=time.time()
+		chi2,phx_dict,g_points,extras=osm(p,this_data)
+		results[symmetry]=[chi2,extras[0],extras[1],time.time()-start]
+		ref=results[False]
+		print '{:>8} {:>22.15g} {:>10.2e} {:>12.6g} {:>10.2e} {:>12.6g} {:>10.2e} {:>8.3f}'.format(str(symmetry),chi2,chi2-ref[0],extras[0],
+			(extras[0]-ref[1])/ref[1] if ref[1] != 0. else 0.,extras[1],(extras[1]-ref[2])/ref[2] if ref[2] != 0. else 0.,results[symmetry][3])
+	use_symmetry=old_symmetry
+	for name,i in [('chi2',0),('L_bol',1),('L_app',2)]:
+		if abs(results[True][i]-results[False][i]) > tol*abs(results[False][i]):
+			raise ValueError('{} is {} over the whole star but {} using its symmetry'.format(name,results[False][i],results[True][i]))
+	return results
+
+def store_spectra(this_arr):
+	"""Converts the (mu x wavelength) intensities of a phoenix model to the precision set by phx_storage. For 'float16',
+	each mu is scaled by its largest intensity first (the intensities are far beyond what float16 can hold), and what's
+	stored is a tuple of the scaled float16 array and the scales. phoenix_rows gets the intensities back out.
+	Inputs:
+	this_arr
+		The (mu x wavelength) array of intensities
+	
+	Outputs:
+	stored
+		The intensities as they're stored
+	"""
+	if isinstance(this_arr,tuple) or phx_storage == 'as read':
+		return this_arr
+	if phx_storage == 'float32':
+		if this_arr.dtype.kind == 'f' and this_arr.dtype.itemsize == 4:	#Already float32 (maybe big-endian, or memory mapped from a pack)
+			return this_arr
+		return np.asarray(this_arr,dtype=np.float32)
+	scales=np.amax(np.abs(this_arr),axis=1).astype(float)
+	scales[scales == 0.]=1.
+	return (np.asarray(this_arr/scales[:,None],dtype=np.float16),scales)
+
+def phoenix_rows(stored,rows):
+	"""Gets rows (mu values) of the intensities of a phoenix model back out of however they're stored (see store_spectra)
+	Inputs:
+	stored
+		The intensities as they're stored in phx_dict
+	rows
+		The index (or indices or slice) of the rows
+	
+	Outputs:
+	intensities
+		The intensities in those rows
+	"""
+	if isinstance(stored,tuple):
+		return stored[0][rows].astype(float)*stored[1][rows][...,None]
+	return stored[rows]
 
-	#Low Temperature, Low Gravity
-	if ll_file in phx_dict:
-		ll_arr = phx_dict[ll_file][2][wl_ind]
-	elif ll_file in path_list:
-		ll_arr=read_this_phoenix(ll_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[2][wl_ind]
-	else:
-		ll_arr=read_this_phoenix_ftp(ll_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[2][wl_ind]
-	#Low Temperature, High Gravity
-	if lh_file in phx_dict:
-		lh_arr = phx_dict[lh_file][2][wl_ind]
-	elif lh_file in path_list:
-		lh_arr=read_this_phoenix(lh_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[2][wl_ind]
-	else:
-		lh_arr=read_this_phoenix_ftp(lh_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[2][wl_ind]
-	#High Temperature, Low Gravity
-	if hl_file in phx_dict:
-		hl_arr = phx_dict[hl_file][2][wl_ind]
-	elif hl_file in path_list:
-		hl_arr=read_this_phoenix(hl_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[2][wl_ind]
-	else:
-		hl_arr=read_this_phoenix_ftp(hl_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[2][wl_ind]
-	#High Temperature, High Gravity
-	if hh_file in phx_dict:
-		hh_arr = phx_dict[hh_file][2][wl_ind]
-	elif hh_file in path_list:
-		hh_arr=read_this_phoenix(hh_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list)[2][wl_ind]
-	else:
-		hh_arr=read_this_phoenix_ftp(hh_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list)[2][wl_ind]
+def phoenix_cache_footprint():
+	"""Reports how much memory the phoenix models loaded in the run are taking up, in every phx_dict (see phoenix_cache).
+	
+	Outputs:
+	footprint
+		Dictionary with the number of models ('models'), how many of them have their full spectrum ('spectra'), the bytes
+		taken up by the full spectra ('spectra_bytes') and by the band integrals ('band_bytes'), and the budget
+		('budget', phx_cache_bytes)
+	"""
+	records=phx_lru.values()
+	return {'models':len(records),'spectra':sum(1 for record in records if record[1] > 0),
+		'spectra_bytes':sum(record[1] for record in records),'band_bytes':sum(record[2] for record in records),'budget':phx_cache_bytes}
 
-	if mlo != mhi:
-		if mlo == 0.:
-			ll=ll_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
-			lh=lh_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
-			hl=hl_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
-			hh=hh_arr[mhi_ind-1]*(mu-mlo)/(mhi-mlo)
-		else:
-			ll=ll_arr[mlo_ind-1]+(ll_arr[mhi_ind-1]-ll_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
-			lh=lh_arr[mlo_ind-1]+(lh_arr[mhi_ind-1]-lh_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
-			hl=hl_arr[mlo_ind-1]+(hl_arr[mhi_ind-1]-hl_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
-			hh=hh_arr[mlo_ind-1]+(hh_arr[mhi_ind-1]-hh_arr[mlo_ind-1])*(mu-mlo)/(mhi-mlo)
+def grid_bracket(grid,x):
+	"""Finds where each value falls in a grid, the same way the extract_phoenix functions do (after rounding to 4 decimals,
+	the grid points just below and just above, which are the same point if the value is on the grid).
+	Inputs:
+	grid
+		Sorted array of the grid points
+	x
+		Array of values
+	
+	Outputs:
+	lo
+		Array of the indices of the grid points just below
+	hi
+		Array of the indices of the grid points just above
+	frac
+		Array of how far each value is between grid[lo] and grid[hi] (0 if they're the same)
+	"""
+	grid=np.asarray(grid,dtype=float)
+	rx=np.round(x,4)
+	lo=np.searchsorted(grid,rx,side='right')-1
+	hi=np.searchsorted(grid,rx,side='left')
+	if np.any(lo < 0) or np.any(hi >= len(grid)):
+		raise ValueError('Values from {} to {} fall outside the grid ({} to {})'.format(np.amin(x),np.amax(x),grid[0],grid[-1]))
+	span=grid[hi]-grid[lo]
+	frac=np.where(span > 0.,(x-grid[lo])/np.where(span > 0.,span,1.),0.)
+	return lo,hi,frac
+
+def phoenix_cube(teff,logg,kind,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list):
+	"""Packs the band-integrated phoenix intensities that are needed for a set of surface points into one dense array
+	indexed by (band, T_eff, log(g), mu), so they can all be interpolated in one go (see interp_cube).
+	Only the T_eff/log(g) models that bracket one of the points get read in (if they haven't been already);
+	the rest of the cube is left as zeros.
+	Inputs:
+	teff
+		Array of the effective temperatures of the points
+	logg
+		Array of the log of the surface gravity of the points
+	kind
+		'vis' to use the vis_filtered intensities (one band for each of uni_wl), or 'phot' to use phot_filtered
+		(one band for each of use_filts)
+	phx_dir
+		The directory the phoenix spectra are located in.
+	use_Z
+		The metallicity used for desired phoenix model spectra.
+	tg_lists
+		A list of lists with teff_list, logg_list, str_teff_list, and str_logg_list
+	phx_mu
+		The list of mu values used by phoenix spectra (with 0 at the front)
+	phx_dict
+		A dictionary with all the saved phoenix spectra in it
+	
+	Outputs:
+	cube
+		Dictionary with the T_eff ('teff'), log(g) ('logg'), and mu ('mu') grid points, and the intensities ('int'),
+		a (band x T_eff x log(g) x mu) array. The intensity at mu=0 is 0.
+	"""
+	catalog=phoenix_catalog(phx_dir,use_Z,tg_lists,mode,wl_list)
+	teff_list=np.array(tg_lists[0])
+	logg_list=np.array(tg_lists[1])
+	str_teff_list=tg_lists[2]
+	str_logg_list=tg_lists[3]
+	ind={'phot':1,'vis':2}[kind]
+	if kind == 'vis':
+		n_band=len(wl_list[2])
 	else:
-		if mlo == 0.:
-			ll=0.
-			lh=0.
-			hl=0.
-			hh=0.
-		else:
-			ll=ll_arr[mlo_ind-1]
-			lh=lh_arr[mlo_ind-1]
-			hl=hl_arr[mlo_ind-1]
-			hh=hh_arr[mlo_ind-1]
+		n_band=len(wl_list[0])
+	
+	tlo,thi,tf=grid_bracket(teff_list,teff)
+	glo,ghi,gf=grid_bracket(logg_list,logg)
+	t0=np.amin(tlo)
+	g0=np.amin(glo)
+	intensity=np.zeros((n_band,np.amax(thi)-t0+1,np.amax(ghi)-g0+1,len(phx_mu)))
+	#Every T_eff/log(g) pair that is a corner of some point's bracket
+	corners=set(zip(tlo,glo))|set(zip(tlo,ghi))|set(zip(thi,glo))|set(zip(thi,ghi))
+	for it,ig in corners:
+		this_file='lte'+str_teff_list[it]+str_logg_list[ig]+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits'
+		this_entry=load_phoenix(this_file,phx_dict,catalog,phx_mu,phx_wav,mode,wl_list)
+		intensity[:,it-t0,ig-g0,1:]=np.array(this_entry[ind])
+	return {'teff':teff_list[t0:np.amax(thi)+1],'logg':logg_list[g0:np.amax(ghi)+1],'mu':np.array(phx_mu),'int':intensity}
+
+def interp_cube(cube,teff,logg,mu):
+	"""Trilinearly interpolates the intensity in every band of a cube (from phoenix_cube) at a set of points, all at once.
+	This matches extract_phoenix_full: points right on a grid value use that value, and the intensity
+	goes linearly to 0 between the smallest phoenix mu and mu=0.
+	Inputs:
+	cube
+		The cube from phoenix_cube
+	teff
+		Array of the effective temperatures of the points
+	logg
+		Array of the log of the surface gravity of the points
+	mu
+		Array of the cosine of the angle between the normal and the line of sight at each point
 	
-	if thi != tlo and ghi != glo:
-		interpolated_flux=ll/(thi-tlo)/(ghi-glo)*(thi-teff)*(ghi-logg)+lh/(thi-tlo)/(ghi-glo)*(thi-teff)*(logg-glo)+hl/(thi-tlo)/(ghi-glo)*(teff-tlo)*(ghi-logg)+hh/(thi-tlo)/(ghi-glo)*(teff-tlo)*(logg-glo)
-	elif thi != tlo and ghi == glo:
-		interpolated_flux=ll+(hl-ll)*(teff-tlo)/(thi-tlo)
-	elif thi == tlo and ghi != glo:		
-		interpolated_flux=ll+(lh-ll)*(logg-glo)/(ghi-glo)
-	elif thi == tlo and ghi == glo:
-		interpolated_flux=ll
-	return interpolated_flux
+	Outputs:
+	intensity
+		(band x point) array of the intensities
+	"""
+	tlo,thi,tf=grid_bracket(cube['teff'],teff)
+	glo,ghi,gf=grid_bracket(cube['logg'],logg)
+	mu=np.where(np.asarray(mu) < 1e-10,0.,mu)
+	mlo,mhi,mf=grid_bracket(cube['mu'],mu)
+	c=cube['int']
+	ll=c[:,tlo,glo,mlo]*(1.-mf)+c[:,tlo,glo,mhi]*mf
+	lh=c[:,tlo,ghi,mlo]*(1.-mf)+c[:,tlo,ghi,mhi]*mf
+	hl=c[:,thi,glo,mlo]*(1.-mf)+c[:,thi,glo,mhi]*mf
+	hh=c[:,thi,ghi,mlo]*(1.-mf)+c[:,thi,ghi,mhi]*mf
+	return (ll*(1.-gf)+lh*gf)*(1.-tf)+(hl*(1.-gf)+hh*gf)*tf
 
 def unitrange(res):
 	"""Outputs an array with values ranging from 0 to 1 with a number of elements given by the input.
@@ -808,6 +1045,51 @@ def unitrange(res):
 		A numpy array that ranges from 0 to 1 with res elements
 	"""
 	return np.arange(res+1)/float(res)
+
+def phi_fold(phi):
+	"""Works out how to do an integral over longitude from half of the longitudes. Everything on the star depends on the
+	longitude only through cos(phi), so when the longitudes are laid out symmetrically about pi (as surface_grid does),
+	the integrand is the same at phi and 2 pi-phi and only the longitudes up to pi need to be worked out.
+	Input:
+	phi
+		The longitudes of the grid
+	Output:
+	n_half
+		How many of the longitudes (from the front) need to be worked out. This is len(phi) if they aren't symmetric or
+		use_symmetry is off.
+	unfold
+		The indices that lay the integrand at the first n_half longitudes back out over all of them
+	"""
+	n=len(phi)
+	if not use_symmetry or not np.allclose(np.asarray(phi)+np.asarray(phi)[::-1],2.*np.pi,rtol=0.,atol=1e-12):
+		return n,np.arange(n)
+	return (n+1)//2,np.minimum(np.arange(n),n-1-np.arange(n))
+
+def colat_fold(colat,*intrinsic):
+	"""Works out how to do an integral over colatitude from the northern half of the star, for things that don't depend on
+	the observer (like L_bol). This works when the colatitudes are laid out symmetrically about the equator and the
+	star is the same above and below it, which gets checked from the intrinsic quantities given.
+	Input:
+	colat
+		The colatitudes of the grid
+	intrinsic
+		Arrays of the quantities the integrand depends on at each colatitude (R, T_eff, log(g), ...)
+	Output:
+	n_half
+		How many of the colatitudes (from the front) need to be worked out. This is len(colat) if the star isn't
+		symmetric or use_symmetry is off.
+	unfold
+		The indices that lay the integrand at the first n_half colatitudes back out over all of them
+	"""
+	n=len(colat)
+	if not use_symmetry or not np.allclose(np.asarray(colat)+np.asarray(colat)[::-1],np.pi,rtol=0.,atol=1e-12):
+		return n,np.arange(n)
+	for quantity in intrinsic:
+		quantity=np.asarray(quantity)
+		if not np.allclose(quantity,quantity[::-1],rtol=1e-10,atol=0.):
+			return n,np.arange(n)
+	return (n+1)//2,np.minimum(np.arange(n),n-1-np.arange(n))
+
 def fwhm(wave,transmission):
 	"""Determines the full width half max of the supplied transmission curve
 	Inputs:
@@ -930,13 +1212,196 @@ def sort_hull_results(sarr,xarr,yarr):
 	ypts.append(ypts[0])
 	return np.array(xpts),np.array(ypts)	
 	
-def extract(tht_x,tht_y,inc,R_e,T_p,beta,R_p,dist,lomg,OMG,m,pa,index,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list):
-	"""Calculates the intensity of the image at the supplied x,y coordinates.
+def roche_radius(colat,sin_colat,R_p,lomg):
+	"""Calculates the radius of the (Roche model) surface of the star as a function of colatitude
+	Inputs:
+	colat
+		Array of colatitudes
+	sin_colat
+		The sines of colat
+	R_p
+		The polar radius
+	lomg
+		The angular rotational velocity relative to the critical
+	
+	Outputs:
+	R
+		Array of the radius at each colatitude (same units as R_p)
+	"""
+	R=np.zeros(len(colat))+R_p
+	if lomg != 0.:
+		off_pole=(colat != 0.)&(colat != np.pi)
+		R[off_pole]=3.*R_p/(lomg*sin_colat[off_pole])*np.cos((np.pi+np.arccos(lomg*sin_colat[off_pole]))/3.)
+	return R
+
+def limb_perimeter(p,R_p,lomg,dist,n_perim):
+	"""Calculates the perimeter of the star from the observer's perspective right from the mu=0 condition.
+	The Roche surface is convex, so each direction psi in the plane of the sky has one point on the limb, where the
+	surface normal points along psi. The colatitude of that point comes from inverting the (monotonic) colatitude of
+	the normal, and its longitude is the azimuth of the normal. Stepping evenly through psi gives the limb already in
+	order, with as many points as asked for no matter how fine the surface grid is.
+	Inputs:
+	p
+		[R_e,vel,inc,T_p,pa] (The equatorial radius, equatorial rotation velocity,
+		inclination, polar temperature, and position angle)
+	R_p
+		The polar radius (in solar radii)
+	lomg
+		The angular rotational velocity relative to the critical
+	dist
+		The distance to the star in parsecs
+	n_perim
+		The number of points on the perimeter
+	
+	Outputs:
+	perim_x
+		x coordinates (in radians) that make up the perimeter of the star (the first point is repeated at the end)
+	perim_y
+		y coordinates (in radians) that make up the perimeter of the star (the first point is repeated at the end)
+	"""
+	inc=p[2]
+	pa=p[4]
+	sin_inc=np.sin(inc)
+	cos_inc=np.cos(inc)
+	
+	#The colatitude of the normal as a function of colatitude. Only the ratio g_t/g_r matters, so the units drop out.
+	colat_tab=unitrange(2000)*np.pi
+	sc=np.sin(colat_tab)
+	cc=np.cos(colat_tab)
+	R_tab=roche_radius(colat_tab,sc,1.,lomg)
+	g_r=-1./R_tab**2.+8./27.*lomg**2.*R_tab*sc**2.
+	g_t=8./27.*lomg**2.*R_tab*sc*cc
+	ncolat_tab=np.arctan2(-g_r*sc-g_t*cc,-g_r*cc+g_t*sc)
+	
+	#The normal pointing along psi in the plane of the sky, in the star's frame
+	psi=np.arange(n_perim)*2.*np.pi/n_perim
+	ncolat=np.arccos(np.clip(np.sin(psi)*sin_inc,-1.,1.))
+	phi=np.arctan2(np.cos(psi),-np.sin(psi)*cos_inc)
+	colat=np.interp(ncolat,ncolat_tab,colat_tab)
+	sin_colat=np.sin(colat)
+	tht_R=roche_radius(colat,sin_colat,R_p,lomg)*R_sun/(dist*pc)
+	
+	#Same coordinates as surface_grid
+	orig_x=tht_R*sin_colat*np.sin(phi)
+	orig_y=tht_R*np.cos(colat)
+	orig_z=tht_R*sin_colat*np.cos(phi)
+	unrot_x=orig_x
+	unrot_y=orig_y*sin_inc-orig_z*cos_inc
+	perim_x=unrot_x*np.cos(pa)-unrot_y*np.sin(pa)
+	perim_y=unrot_x*np.sin(pa)+unrot_y*np.cos(pa)
+	return np.append(perim_x,perim_x[0]),np.append(perim_y,perim_y[0])
+
+def hull_perimeter(x,y):
+	"""Finds the perimeter of a set of points as their convex hull. In 2D, ConvexHull already lists the vertices
+	of the hull in order, so they just need to be picked out (no sorting needed).
+	Inputs:
+	x
+		Array of x coordinates of the points
+	y
+		Array of y coordinates of the points
+	
+	Outputs:
+	perim_x
+		x coordinates that make up the perimeter (the first point is repeated at the end)
+	perim_y
+		y coordinates that make up the perimeter (the first point is repeated at the end)
+	"""
+	hull=ConvexHull(np.column_stack((x,y)))
+	vertices=np.append(hull.vertices,hull.vertices[0])
+	return x[vertices],y[vertices]
+
+def surface_grid(p,m,beta,dist,colat_len,phi_len,mode):
+	"""Lays out the colatitude/longitude grid over the surface of the star and works out the radius, surface gravity,
+	effective temperature, mu, and sky coordinates of every point on it. Everything is done with arrays, so finer grids
+	cost very little more (see bench_grid.py).
+	Inputs:
+	p
+		[R_e,vel,inc,T_p,pa] (The equatorial radius, equatorial rotation velocity,
+		inclination, polar temperature, and position angle)
+	m
+		The mass of the star in solar masses
+	beta
+		The gravity darkening coefficient (replaced if 'z' or 'r' is in mode)
+	dist
+		The distance to the star in parsecs
+	colat_len
+		The number of colatitudes in the grid
+	phi_len
+		The number of longitudes in the grid
+	
+	Outputs:
+	colat,phi,sin_colat,cos_colat,cos_phi
+		The colatitudes and longitudes of the grid (and their sines and cosines)
+	R_p,lomg,OMG,g_p,beta
+		The polar radius, angular rotational velocity relative to critical, angular rotational velocity,
+		polar surface gravity, and gravity darkening coefficient
+	R,tht_R,g,g_r,g_t,lg,T_eff
+		The physical radius (solar radii), angular radius (radians), surface gravity (and its radial and tangential parts),
+		log(g), and effective temperature as a function of colatitude
+	mu
+		(colat_len x phi_len) array of the cosine of the angle between the normal of the star and the observer
+	x,y,z
+		(colat_len x phi_len) arrays of the sky coordinates (in radians) of each point on the grid, with z towards the observer
+	"""
+	R_e,vel,inc,T_p,pa=p
+	sin_inc=np.sin(inc)
+	cos_inc=np.cos(inc)
+	sin_pa=np.sin(pa)
+	cos_pa=np.cos(pa)
+	
+	#Define the latitude/longitude grid
+	colat=unitrange(colat_len-1)*np.pi
+	sin_colat=np.sin(colat)
+	cos_colat=np.cos(colat)
+	phi=unitrange(phi_len-1)*2.*np.pi
+	sin_phi=np.sin(phi)
+	cos_phi=np.cos(phi)
+	
+	#Calculated values
+	R_p=1./(1./R_e+(vel*1e5)**2./(2.*(NG*M_sun/R_sun)*m))	#Polar Radius
+	w_0=(vel*1e5)**2.*R_p/(2.*(NG*M_sun/R_sun)*m)
+	lomg=np.sqrt(27./4.*w_0*(1.-w_0)**2.)			#angular rotational velocity relative to the critical
+	if 'z' in mode:
+		beta=0.25
+	if 'r' in mode:
+		beta=calc_beta(lomg)
+	OMG_crit=np.sqrt(8./27.*NG*m*M_sun/(R_p*R_sun)**3.)	#Critical angular rotational velocity
+	OMG=lomg*OMG_crit				#angular rotational velocity
+	g_p=NG*(m*M_sun)/(R_p*R_sun)**2.			#Polar surface gravity
+	#This defines the physical radius (in solar radii) and surface gravity of the star as a function of colatitude
+	R=roche_radius(colat,sin_colat,R_p,lomg)
+	g_r=-NG*(m*M_sun)/(R*R_sun)**2.+R*R_sun*(OMG*sin_colat)**2.
+	g_t=R*R_sun*OMG**2.*sin_colat*cos_colat
+	g=np.sqrt(g_r**2.+g_t**2.)
+	lg=np.log10(g)
+	tht_R=(R*R_sun)/(dist*pc)	#Angular Radius as a function of colatitude in radians
+	T_eff=T_p*(g/g_p)**beta	#Effective temperature as a function of colatitude in Kelvins
+	
+	#The x,y,z coordinates of each point on the grid as well as mu, the cosine of the angle between the normal of the star and the observer
+	sc=sin_colat[:,np.newaxis]
+	cc=cos_colat[:,np.newaxis]
+	orig_x=(tht_R*sin_colat)[:,np.newaxis]*sin_phi	#x coordinate before inclination and rotation
+	orig_y=(tht_R*cos_colat)[:,np.newaxis]*np.ones(len(phi))	#y coordinate before inclination and rotation
+	orig_z=(tht_R*sin_colat)[:,np.newaxis]*cos_phi	#z coordinate before inclination and rotation
+	mu=1.0/g[:,np.newaxis]*(-1.0*g_r[:,np.newaxis]*(sc*sin_inc*cos_phi+cc*cos_inc)-g_t[:,np.newaxis]*(sin_inc*cos_phi*cc-sc*cos_inc))
+	#unrot_x,y,z have been inclined, but not rotated
+	unrot_x=orig_x
+	unrot_y=orig_y*sin_inc-orig_z*cos_inc
+	unrot_z=orig_y*cos_inc+orig_z*sin_inc
+	#x,y,z have been both inclined and rotated
+	x=unrot_x*cos_pa-unrot_y*sin_pa
+	y=unrot_x*sin_pa+unrot_y*cos_pa
+	z=unrot_z
+	return colat,phi,sin_colat,cos_colat,cos_phi,R_p,lomg,OMG,g_p,beta,R,tht_R,g,g_r,g_t,lg,T_eff,mu,x,y,z
+
+def extract_geometry(tht_x,tht_y,inc,R_e,T_p,beta,R_p,dist,lomg,OMG,m,pa):
+	"""Calculates the surface properties of the star seen at each of the supplied x,y coordinates all at once.
+	This does the same calculation as extract (minus the phoenix look up), but on whole arrays of pixels.
 	Inputs:
 	tht_x
-		x coordinate of interest in radians
+		Array of x coordinates of interest in radians
 	tht_y
-		y coordinate of interest in radians
+		Array of y coordinates of interest in radians
 	inc
 		The inclination of the model star
 	pa
@@ -947,98 +1412,179 @@ def extract(tht_x,tht_y,inc,R_e,T_p,beta,R_p,dist,lomg,OMG,m,pa,index,phx_dir,ph
 		The polar radius of the model star
 	lomg
 		The fraction angular velocity (relative to critical) of the model star
-	index
-		The index of uni_wl for the image
-	phx_dir
-		The directory the phoenix spectra are located in.
-	use_Z
-		The metallicity used for desired phoenix model spectra. This is used in determining
-		the ftp path for using  
-	tg_lists
-		A list of lists with teff_list, logg_list, str_teff_list, and str_logg_list
-	phx_mu
-		The list of mu values used by phoenix spectra
-	phx_dict
-		A dictionary with all the saved phoenix spectra in it
 	
 	Outputs:
-	intensity
-		A float of the intensity at the given x,y coordinates
+	tht_xyz
+		Array of the colatitudes of the surface at the given x,y coordinates
+	phi_xyz
+		Array of the longitudes of the surface at the given x,y coordinates
+	mu
+		Array of the cosines of the angle between the surface normal and the line of sight
+	T_eff
+		Array of the effective temperatures at the given x,y coordinates
+	lg
+		Array of the log of the surface gravity at the given x,y coordinates
+	converged
+		Boolean array that's False wherever surface_depth couldn't find the surface
 	"""
 	#Convert x and y into solar units (from radians)
-	x=tht_x*dist*pc/R_sun
-	y=tht_y*dist*pc/R_sun
-	#Start with an assumption for z such that star is a sphere
-	zass=np.sqrt(R_e**2.-x**2.-y**2.)
-	R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)	#Convert x,y, and zass from cartesian to spherical coordinates
-	
-	if inc==0 and x==0 and y==0:
-		R_tht=R_p
-	else:
-		R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-		
-		#If the radius you expect from (x,y,zass) doesn't match the radius you expect from the tht and phi that
-		#	are associated with x,y,zass, then zass gets changed until they do match to within 0.1%.
-		if abs(R_tht-R_xyz)/R_tht*100. > 0.1:
-			while zass > 0 and R_tht < R_xyz:
-				zass-=5e-2*R_e
-				R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-				R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-			zass+=5e-2*R_e
-			R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-			R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-		if abs(R_tht-R_xyz)/R_tht*100. > 0.1:
-			while zass > 0 and R_tht < R_xyz:
-				zass-=1e-2*R_e
-				R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-				R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-			zass+=1e-2*R_e
-			R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-			R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-		if abs(R_tht-R_xyz)/R_tht*100. > 0.1:
-			while zass > 0 and R_tht < R_xyz:
-				zass-=1e-3*R_e
-				R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-				R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-			zass+=1e-3*R_e
-			R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-			R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-		if abs(R_tht-R_xyz)/R_tht*100. > 0.1:
-			while zass > 0 and R_tht < R_xyz:
-				zass-=1e-4*R_e
-				R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-				R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-			zass+=1e-4*R_e
-			R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-			R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-		if abs(R_tht-R_xyz)/R_tht*100. > 0.1:
-			while zass > 0 and R_tht < R_xyz:
-				zass-=1e-5*R_e
-				R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-				R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-			zass+=1e-5*R_e
-			R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-			R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-		if abs(R_tht-R_xyz)/R_tht*100. > 0.1:
-			while zass > 0 and R_tht < R_xyz:
-				zass-=1e-6*R_e
-				R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-				R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-			zass+=1e-6*R_e
-			R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,zass,inc,pa)
-			R_tht=3.*R_p/(lomg*np.sin(tht_xyz))*np.cos((np.pi+np.arccos(lomg*np.sin(tht_xyz)))/3.) #Radius as a function of colatitude
-		
+	x=np.asarray(tht_x,dtype=float)*dist*pc/R_sun
+	y=np.asarray(tht_y,dtype=float)*dist*pc/R_sun
+	R_xyz,tht_xyz,phi_xyz,converged=surface_depth(x,y,inc,R_e,R_p,lomg,pa)
+	
 	g_t=R_xyz*R_sun*OMG**2.*np.sin(tht_xyz)*np.cos(tht_xyz)
 	g_r=-NG*(m*M_sun)/(R_xyz*R_sun)**2.+R_xyz*R_sun*(OMG*np.sin(tht_xyz))**2.
 	g=np.sqrt(g_r**2.+g_t**2.)
 	mu=1.0/g*(-1.0*g_r*(np.sin(tht_xyz)*np.sin(inc)*np.cos(phi_xyz)+np.cos(tht_xyz)*np.cos(inc))-g_t*(np.sin(inc)*np.cos(phi_xyz)*np.cos(tht_xyz)-np.sin(tht_xyz)*np.cos(inc)))
 	g_p=NG*(m*M_sun)/(R_p*R_sun)**2.			#Polar surface gravity
 	T_eff=T_p*(g/g_p)**beta	#Effective temperature as a function of colatitude in Kelvins
+	return tht_xyz,phi_xyz,mu,T_eff,np.log10(g),converged
+
+def surface_depth(x,y,inc,R_e,R_p,lomg,pa,tol=1e-10,itmax=50):
+	"""Finds where the line of sight through each x,y coordinate first hits the surface of the star.
+	The surface is where the Roche potential equals its polar value. Written in units of R_p, that is
+		F(z) = 1/r + 4/27*lomg^2*s^2 - 1 = 0
+	where r is the distance from the center and s is the distance from the rotation axis. Along a line of sight both
+	r^2 and s^2 are quadratics in z, so F and dF/dz are cheap. The line of sight is sampled from the front of the
+	sphere of radius R_e to its back to bracket the first crossing, and then Newton's method (falling back on
+	bisection whenever a step would leave the bracket) converges on it quadratically. All of the coordinates are
+	solved together.
+	The radius found here matches the Roche radius to ~tol (checked to 1e-10). That includes pixels near the limb where
+	the visible surface lies behind the plane of the sky. The staged search this replaced couldn't get there (it
+	stopped at the plane of the sky, and once its radius was within 0.1% of the Roche radius), so it was off by up to
+	~2% in R and ~0.2 in colatitude at those pixels for fast rotators.
+	Inputs:
+	x
+		Array of x coordinates in solar radii
+	y
+		Array of y coordinates in solar radii
+	inc
+		The inclination of the model star
+	R_e
+		The equatorial radius of the model star
+	R_p
+		The polar radius of the model star
+	lomg
+		The fraction angular velocity (relative to critical) of the model star
+	pa
+		The position angle of the model star
+	tol
+		The convergence tolerance in z (in units of R_p)
+	itmax
+		The maximum number of Newton iterations
 	
-	intensity=extract_phoenix_vis(T_eff,np.log10(g),mu,index,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list)
-	return intensity	
-
-
+	Outputs:
+	R_xyz
+		Array of the radii (in solar radii) of the surface points
+	tht_xyz
+		Array of the colatitudes of the surface points
+	phi_xyz
+		Array of the longitudes of the surface points
+	converged
+		Boolean array that's False wherever no crossing was found to within tol (these are left at the
+		point along the line of sight that comes closest to the surface)
+	"""
+	x=np.atleast_1d(np.asarray(x,dtype=float))
+	y=np.atleast_1d(np.asarray(y,dtype=float))
+	a=4./27.*lomg**2.
+	sin_inc=np.sin(inc)
+	cos_inc=np.cos(inc)
+	#Everything in units of R_p. xx is the coordinate along the axis that doesn't get inclined, yy the one that does
+	xx=(x*np.cos(pa)+y*np.sin(pa))/R_p
+	yy=(-x*np.sin(pa)+y*np.cos(pa))/R_p
+	rr0=xx**2.+yy**2.
+	def roche(z,i):
+		#F and dF/dz along the line of sight of the pixels i
+		r=np.sqrt(rr0[i]+z**2.)
+		zt=z*sin_inc-yy[i]*cos_inc
+		F=1./r+a*(xx[i]**2.+zt**2.)-1.
+		dF=-z/r**3.+2.*a*sin_inc*zt
+		return F,dF
+	
+	all_i=np.arange(len(x))
+	z_s=np.sqrt(np.clip(R_e**2.-x**2.-y**2.,0.,None))/R_p	#The front of the sphere of radius R_e
+	#Bracket the first crossing: z_out is outside the star (F <= 0) and z_in is inside (F > 0)
+	n_samp=16
+	z_out=z_s.copy()
+	z_in=np.zeros(len(x))
+	found=np.zeros(len(x),dtype=bool)
+	lo=-z_s.copy()
+	hi=z_s.copy()
+	F_s,dF_s=roche(z_s,all_i)
+	found[F_s >= 0.]=True	#Right on the equator the front of the sphere is already on the surface
+	z_in[found]=z_s[found]
+	z_best=z_s.copy()
+	for zoom in range(20):
+		look=np.where(~found)[0]
+		if len(look) == 0 or np.amax(hi[look]-lo[look]) < tol:
+			break
+		zs=hi[look,None]-(hi[look,None]-lo[look,None])*np.arange(n_samp+1)/float(n_samp)
+		F,dF=roche(zs,look[:,None])
+		pos=F > 0.
+		hit=pos.any(axis=1)
+		first=np.argmax(pos,axis=1)
+		j=look[hit]
+		z_in[j]=zs[hit,first[hit]]
+		z_out[j]=zs[hit,first[hit]-1]
+		found[j]=True
+		#Lines of sight that only graze the star: zoom in around the point that comes closest to the surface
+		miss=~hit
+		best=np.argmax(F[miss],axis=1)
+		j=look[miss]
+		step=(hi[j]-lo[j])/float(n_samp)
+		z_best[j]=zs[miss][np.arange(len(j)),best]
+		hi[j]=np.minimum(z_best[j]+step,z_s[j])
+		lo[j]=np.maximum(z_best[j]-step,-z_s[j])
+	
+	#Newton's method, kept inside the bracket
+	z=z_best.copy()
+	z[found]=z_out[found]
+	converged=found&(z_in == z_out)
+	for it in range(itmax):
+		i=np.where(found&~converged)[0]
+		if len(i) == 0:
+			break
+		F,dF=roche(z[i],i)
+		inside_i=F > 0.
+		z_in[i[inside_i]]=z[i[inside_i]]
+		z_out[i[~inside_i]]=z[i[~inside_i]]
+		z_new=z[i]-F/np.where(dF == 0.,np.inf,dF)
+		bisect=~((z_new > np.minimum(z_in[i],z_out[i]))&(z_new < np.maximum(z_in[i],z_out[i])))
+		z_new[bisect]=0.5*(z_in[i][bisect]+z_out[i][bisect])
+		converged[i]=(abs(z_new-z[i]) < tol)|(abs(z_in[i]-z_out[i]) < tol)
+		z[i]=z_new
+	
+	R_xyz,tht_xyz,phi_xyz=cart2sphere(x,y,z*R_p,inc,pa)
+	return R_xyz,tht_xyz,phi_xyz,converged
+
+def render_image(dlin,perim_x,perim_y,inc,R_e,T_p,beta,R_p,dist,lomg,OMG,m,pa):
+	"""Finds every pixel of the model image that lands on the star and works out what part of the surface it sees.
+	Inputs:
+	dlin
+		The angular coordinates (in radians) of the pixels along each axis of the model image
+	perim_x
+		x coordinates that make up the perimeter of the star
+	perim_y
+		y coordinates that make up the perimeter of the star
+	
+	Outputs:
+	yi
+		Array of the row indices of the pixels on the star
+	xi
+		Array of the column indices of the pixels on the star
+	tht_xyz,phi_xyz,mu,T_eff,lg,converged
+		Arrays of the surface properties at each of those pixels (see extract_geometry)
+	"""
+	#Only the box around the perimeter can have pixels on the star
+	box_x=np.where((dlin >= np.amin(perim_x))&(dlin <= np.amax(perim_x)))[0]
+	box_y=np.where((dlin >= np.amin(perim_y))&(dlin <= np.amax(perim_y)))[0]
+	on_star=inside.inside_grid(dlin[box_x],dlin[box_y],perim_x,perim_y)
+	yi,xi=np.nonzero(on_star)
+	yi=box_y[yi]
+	xi=box_x[xi]
+	
+	tht_xyz,phi_xyz,mu,T_eff,lg,converged=extract_geometry(dlin[xi],dlin[yi],inc,R_e,T_p,beta,R_p,dist,lomg,OMG,m,pa)
+	return yi,xi,tht_xyz,phi_xyz,mu,T_eff,lg,converged
 
 def cart2sphere(xxx,yyy,zzz,inc,pa):
 	"""Converts the input cartesian coordinates into spherical coordinates (adjusting for inclination and position angle of the star)
@@ -1564,36 +2110,581 @@ def store_mesa(fil):
 	wnow
 		An array with the Angular rotation rate/critical at the current age of the mass track
 	"""
-	age=[]
-	teff=[]
-	lum=[]
-	rad=[]
-	r_p=[]
-	vel=[]
-	wnow=[]
-	with open(fil,'r') as input:
-		input_reader=csv.reader(input,delimiter=' ',skipinitialspace=True)
-		input_reader.next()
-		for line in input_reader:
-			if len(line)==17 and line[1] != '2' and line[1] !='star_age':
-				if float(line[13])*10**(float(line[5])) > 0.0:
-					age.append(float(line[1])*1e-9)			#Age in Gyr	
-					teff.append(float(line[3]))				#log(T_eff/K)
-					lum.append(float(line[4]))				#log(L/L_sun)
-					rad.append(float(line[5]))				#log(R/R_sun)
-					r_p.append(np.log10(float(line[13])*10**(float(line[5]))))	#log(R_p/R_sun)
-					vel.append(float(line[14]))				#Equatorial Velocity in km/s
-					wnow.append(float(line[15]))				#Angular rotation rate/critical at the current age
-
-	age=np.array(age)
-	teff=np.array(teff)
-	lum=np.array(lum)
-	rad=np.array(rad)
-	r_p=np.array(r_p)
-	vel=np.array(vel)
-	wnow=np.array(wnow)
-	return [age,teff,lum,rad,r_p,vel,wnow]
+	age=[]
+	teff=[]
+	lum=[]
+	rad=[]
+	r_p=[]
+	vel=[]
+	wnow=[]
+	with open(fil,'r') as input:
+		input_reader=csv.reader(input,delimiter=' ',skipinitialspace=True)
+		input_reader.next()
+		for line in input_reader:
+			if len(line)==17 and line[1] != '2' and line[1] !='star_age':
+				if float(line[13])*10**(float(line[5])) > 0.0:
+					age.append(float(line[1])*1e-9)			#Age in Gyr	
+					teff.append(float(line[3]))				#log(T_eff/K)
+					lum.append(float(line[4]))				#log(L/L_sun)
+					rad.append(float(line[5]))				#log(R/R_sun)
+					r_p.append(np.log10(float(line[13])*10**(float(line[5]))))	#log(R_p/R_sun)
+					vel.append(float(line[14]))				#Equatorial Velocity in km/s
+					wnow.append(float(line[15]))				#Angular rotation rate/critical at the current age
+
+	age=np.array(age)
+	teff=np.array(teff)
+	lum=np.array(lum)
+	rad=np.array(rad)
+	r_p=np.array(r_p)
+	vel=np.array(vel)
+	wnow=np.array(wnow)
+	return [age,teff,lum,rad,r_p,vel,wnow]
+
+
+def pack_phoenix(phx_dir,use_Z):
+	"""Packs all of the phoenix SPECINT files for one metallicity into one file that can be memory mapped
+	(phx_dir+use_Z+'.phxpack'), so the intensities can be read straight off the disk (and shared between processes
+	through the page cache) instead of decoding the FITS files. This only needs to be done once (see pack_phoenix.py).
+	The file starts with 'PHXPACK1', the length of the header, and the header itself (JSON), which lists the files
+	along with their T_eff and log(g), the mu values, the wavelength grid, and where the data start. The data are
+	then one float32 (file x mu x wavelength) array, sorted by T_eff and then log(g).
+	Inputs:
+	phx_dir
+		The directory the phoenix spectra are located in (without the metallicity)
+	use_Z
+		The metallicity of the phoenix model spectra to pack
+	
+	Outputs:
+	pack_file
+		The name of the file that was written
+	"""
+	import json
+	import struct
+	fits_dir=phx_dir+use_Z+'/'
+	pack_file=phx_dir+use_Z+'.phxpack'
+	files=[f for f in os.listdir(fits_dir) if f.startswith('lte') and f.endswith('.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits')]
+	files.sort(key=lambda f: (int(f[3:8]),abs(float(f[8:13]))))
+	this_arr,this_mu=open_phoenix(fits_dir,files[0])
+	shape=(len(files),)+np.shape(this_arr)
+	header={'files':files,'teff':[int(f[3:8]) for f in files],'logg':[abs(float(f[8:13])) for f in files],
+		'mu':[float(x) for x in this_mu],'wav':[500e-8,1e-8,shape[2]],'shape':list(shape),'dtype':'float32'}
+	header['offset']=0
+	text=json.dumps(header)
+	header['offset']=(len(text)+64)//4096*4096+4096	#Start the data on a page boundary after the header
+	text=json.dumps(header)
+	with open(pack_file,'wb') as out:
+		out.write('PHXPACK1')
+		out.write(struct.pack('<Q',len(text)))
+		out.write(text)
+		out.seek(header['offset']+4*shape[0]*shape[1]*shape[2]-1)
+		out.write('\0')
+	data=np.memmap(pack_file,dtype=np.float32,mode='r+',offset=header['offset'],shape=shape)
+	for i in range(len(files)):
+		print 'Packing {} ({} of {})'.format(files[i],i+1,len(files))
+		this_arr,this_mu=open_phoenix(fits_dir,files[i])
+		if np.shape(this_arr) != shape[1:] or np.any(np.array(this_mu) != np.array(header['mu'])):
+			print '{} is on a different mu or wavelength grid than {}. Leaving it out.'.format(files[i],files[0])
+			continue
+		data[i]=this_arr
+	data.flush()
+	del data
+	phx_packs.pop(fits_dir,None)
+	phx_catalogs.clear()
+	return pack_file
+
+def open_phoenix_pack(fits_dir):
+	"""Opens (memory maps) the packed phoenix grid for a directory of phoenix spectra if there is one (see pack_phoenix).
+	Packs are only opened once and then kept in phx_packs.
+	Inputs:
+	fits_dir
+		The directory the phoenix spectra for one metallicity are (or were) located in, e.g. phx_dir+'Z-0.0/'
+	
+	Outputs:
+	pack
+		None if there's no pack. Otherwise a dictionary with the index of each file in the pack ('index'), the T_eff,
+		log(g), and mu values ('teff', 'logg', 'mu'), the wavelengths ('wav', in cm), and the memory mapped
+		(file x mu x wavelength) intensities ('int')
+	"""
+	if fits_dir in phx_packs:
+		return phx_packs[fits_dir]
+	import json
+	import struct
+	pack_file=fits_dir.rstrip('/')+'.phxpack'
+	pack=None
+	if os.path.isfile(pack_file):
+		with open(pack_file,'rb') as inp:
+			if inp.read(8) != 'PHXPACK1':
+				print '{} is not a packed phoenix grid. Ignoring it.'.format(pack_file)
+				phx_packs[fits_dir]=None
+				return None
+			header=json.loads(inp.read(struct.unpack('<Q',inp.read(8))[0]))
+		pack={'index':dict((f,i) for i,f in enumerate(header['files'])),'teff':np.array(header['teff']),'logg':np.array(header['logg']),
+			'mu':np.array(header['mu']),'wav':header['wav'][0]+np.arange(header['wav'][2])*header['wav'][1],
+			'int':np.memmap(pack_file,dtype=header['dtype'],mode='r',offset=header['offset'],shape=tuple(header['shape']))}
+	phx_packs[fits_dir]=pack
+	return pack
+
+def open_phoenix(fits_dir,this_file):
+	"""Gets the intensities and mu values of one phoenix model, from the packed grid (with no copying) if it's in there
+	and from the FITS file if it's not.
+	Inputs:
+	fits_dir
+		The directory the phoenix spectra for one metallicity are located in, e.g. phx_dir+'Z-0.0/'
+	this_file
+		The phoenix .fits file
+	
+	Outputs:
+	this_arr
+		The (mu x wavelength) array of intensities
+	this_mu
+		The mu values of this_arr
+	"""
+	pack=open_phoenix_pack(fits_dir)
+	if pack is not None and this_file in pack['index']:
+		return pack['int'][pack['index'][this_file]],pack['mu']
+	this_hdulist = pyfits.open(fits_dir+this_file)
+	this_arr=this_hdulist[0].data
+	this_mu=this_hdulist[1].data
+	this_hdulist.close()
+	return this_arr,this_mu
+
+def full_spectra(mode):
+	"""Whether the full phoenix spectra are kept: for luminosities ('L') and plots ('P'), unless plots are done with the
+	compressed grid ('c', see pca_phoenix). The luminosities come from the integrated intensities of the models (see
+	phoenix_bol_cell), so with 'c' the full spectrum of a model is only read when those haven't been worked out yet.
+	Inputs:
+	mode
+		The mode string
+	
+	Outputs:
+	needed
+		True if they're needed
+	"""
+	return ('L' in mode or 'P' in mode) and 'c' not in mode
+
+def pca_phoenix(phx_dir,use_Z,n_basis=60,n_iter=2):
+	"""Compresses the local phoenix grid for one metallicity: every (T_eff, log(g), mu) spectrum is written as n_basis
+	coefficients on a basis of spectra shared by the whole grid (the top principal components of the spectra, each
+	scaled to unit length so the faint ones count as much as the bright ones). The basis is found with a randomized SVD
+	that goes through the grid one model at a time, so the grid never has to fit in memory. The basis, coefficients,
+	and how well each spectrum is reconstructed are saved next to the grid, where open_phoenix_pca finds them.
+	Inputs:
+	phx_dir
+		The directory the phoenix spectra are located in (without the metallicity)
+	use_Z
+		The metallicity of the phoenix model spectra to compress
+	n_basis
+		The number of basis spectra
+	n_iter
+		The number of power iterations for the randomized SVD (more is more accurate, but each one reads the grid again)
+	
+	Outputs:
+	pca_file
+		The name of the file that was written
+	"""
+	fits_dir=phx_dir+use_Z+'/'
+	pca_file=fits_dir.rstrip('/')+'_pca.npz'
+	files=[f for f in set(phoenix_files(fits_dir)) if f.startswith('lte') and f.endswith('.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits')]
+	files.sort(key=lambda f: (int(f[3:8]),abs(float(f[8:13]))))
+	
+	def read_scaled(this_file):
+		this_arr,this_mu=open_phoenix(fits_dir,this_file)
+		this_arr=np.asarray(this_arr,dtype=float)
+		norms=np.sqrt(np.sum(this_arr**2,axis=1))
+		return this_arr,this_arr/np.where(norms > 0.,norms,1.)[:,None],norms,this_mu
+	
+	#Sketch of the row space of the (all spectra x wavelength) matrix, refined with power iterations
+	this_arr,scaled,norms,phx_mu=read_scaled(files[0])
+	n_wav=np.shape(this_arr)[1]
+	n_sketch=min(n_basis+10,len(files)*len(phx_mu),n_wav)
+	rand=np.random.RandomState(0)
+	sketch=np.zeros((n_sketch,n_wav))
+	for i in range(len(files)):
+		print 'Sketching {} ({} of {})'.format(files[i],i+1,len(files))
+		this_arr,scaled,norms,this_mu=read_scaled(files[i])
+		sketch+=np.dot(rand.standard_normal((n_sketch,len(scaled))),scaled)
+	basis=np.linalg.qr(sketch.T)[0]
+	for it in range(n_iter):
+		sketch=np.zeros((n_wav,n_sketch))
+		for i in range(len(files)):
+			print 'Power iteration {}: {} ({} of {})'.format(it+1,files[i],i+1,len(files))
+			this_arr,scaled,norms,this_mu=read_scaled(files[i])
+			sketch+=np.dot(scaled.T,np.dot(scaled,basis))
+		basis=np.linalg.qr(sketch)[0]
+	projected=[]
+	for i in range(len(files)):
+		this_arr,scaled,norms,this_mu=read_scaled(files[i])
+		projected.append(np.dot(scaled,basis))
+	u,sv,w=np.linalg.svd(np.concatenate(projected),full_matrices=False)
+	basis=np.dot(basis,w[:n_basis].T).T	#(n_basis x wavelength), orthonormal rows
+	
+	#The coefficients of every spectrum, and how far the reconstruction is from it
+	weights=trapz_weights(n_wav)
+	coef=np.zeros((len(files),len(phx_mu),len(basis)))
+	err_l2=np.zeros((len(files),len(phx_mu)))
+	err_bol=np.zeros((len(files),len(phx_mu)))
+	for i in range(len(files)):
+		print 'Projecting {} ({} of {})'.format(files[i],i+1,len(files))
+		this_arr,scaled,norms,this_mu=read_scaled(files[i])
+		coef[i]=np.dot(this_arr,basis.T)
+		diff=this_arr-np.dot(coef[i],basis)
+		err_l2[i]=np.sqrt(np.sum(diff**2,axis=1))/np.where(norms > 0.,norms,1.)
+		err_bol[i]=abs(np.dot(diff,weights))/np.where(np.dot(this_arr,weights) > 0.,np.dot(this_arr,weights),1.)
+	np.savez(pca_file,files=np.array(files),mu=np.array(phx_mu),basis=basis,coef=coef,err_l2=err_l2,err_bol=err_bol)
+	print 'Relative error of the reconstructed spectra: {:.2e} at most, {:.2e} median'.format(np.amax(err_l2),np.median(err_l2))
+	print 'Relative error of their integrals over wavelength: {:.2e} at most'.format(np.amax(err_bol))
+	phx_pcas.pop(fits_dir,None)
+	return pca_file
+
+def open_phoenix_pca(fits_dir):
+	"""Loads the compressed phoenix grid for a directory of phoenix spectra (see pca_phoenix). They're only loaded once
+	and then kept in phx_pcas.
+	Inputs:
+	fits_dir
+		The directory the phoenix spectra for one metallicity are located in, e.g. phx_dir+'Z-0.0/'
+	
+	Outputs:
+	pca
+		Dictionary with the basis spectra ('basis'), the (mu x basis) coefficients of each model ('coef', by file name,
+		with a row of zeros for mu=0 at the front), and the largest relative errors of the reconstructed spectra
+		('err_l2') and of their integrals over wavelength ('err_bol')
+	"""
+	if fits_dir in phx_pcas:
+		return phx_pcas[fits_dir]
+	pca_file=fits_dir.rstrip('/')+'_pca.npz'
+	if not os.path.isfile(pca_file):
+		raise IOError('There is no compressed phoenix grid ({}). Make it with pca_phoenix.'.format(pca_file))
+	data=np.load(pca_file)
+	basis=data['basis']
+	coef=dict()
+	for i in range(len(data['files'])):
+		coef[str(data['files'][i])]=np.concatenate((np.zeros((1,len(basis))),data['coef'][i]))
+	pca={'basis':basis,'coef':coef,'err_l2':np.amax(data['err_l2']),'err_bol':np.amax(data['err_bol'])}
+	print 'Compressed phoenix grid {}: {} basis spectra, reconstruction error {:.2e} (spectra), {:.2e} (integrals)'.format(pca_file,len(basis),pca['err_l2'],pca['err_bol'])
+	phx_pcas[fits_dir]=pca
+	return pca
+
+def phoenix_files(fits_dir,mode='',wl_list=None):
+	"""Lists the phoenix models that are available locally, as FITS files or in the packed grid. If wl_list is given and
+	the full spectra aren't needed ('L' and 'P' aren't in mode), models whose band integrals have been precomputed
+	(see precompute_bands) count too.
+	Inputs:
+	fits_dir
+		The directory the phoenix spectra for one metallicity are located in, e.g. phx_dir+'Z-0.0/'
+	mode
+		The mode string
+	wl_list
+		[use_filts,filt_dict,uni_wl,uni_dwl]
+	
+	Outputs:
+	path_list
+		List of the file names
+	"""
+	path_list=[]
+	if os.path.isdir(fits_dir):
+		path_list=os.listdir(fits_dir)
+	pack=open_phoenix_pack(fits_dir)
+	if pack is not None:
+		path_list=path_list+pack['index'].keys()
+	if wl_list is not None and not full_spectra(mode):
+		cached_bands('',fits_dir,wl_list)
+		path_list=path_list+phx_bands[band_cache_file(fits_dir,wl_list)].keys()
+	return path_list
+
+def phoenix_catalog(phx_dir,use_Z,tg_lists,mode,wl_list):
+	"""Works out which models of the phoenix grid can be read locally and which have to come from the phoenix ftp site.
+	The directory is only scanned the first time (per grid, and per whether precomputed band integrals can be used),
+	after that the catalog is kept in phx_catalogs. Call phx_catalogs.clear() if files are added to the grid while running.
+	Inputs:
+	phx_dir
+		The directory the phoenix spectra are located in (without the metallicity)
+	use_Z
+		The metallicity used for desired phoenix model spectra.
+	tg_lists
+		A list of lists with teff_list, logg_list, str_teff_list, and str_logg_list
+	mode
+		The mode string
+	wl_list
+		[use_filts,filt_dict,uni_wl,uni_dwl]
+	
+	Outputs:
+	catalog
+		Dictionary with the local directory ('dir') and the phx_source directory ('source') of the grid, and sets of the file names of
+		the models that are available locally ('local'), that will have to be fetched ('remote'), and that couldn't be
+		fetched ('missing')
+	"""
+	fits_dir=phx_dir+use_Z+'/'
+	if wl_list is not None and not full_spectra(mode):
+		key=(fits_dir,band_cache_file(fits_dir,wl_list))
+	else:
+		key=(fits_dir,None)
+	if key in phx_catalogs:
+		return phx_catalogs[key]
+	local=set(phoenix_files(fits_dir,mode,wl_list))
+	grid=set()
+	for str_teff in tg_lists[2]:
+		for str_logg in tg_lists[3]:
+			grid.add('lte'+str_teff+str_logg+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits')
+	catalog={'dir':fits_dir,'source':phx_source+use_Z+'/',
+		'local':local,'remote':grid-local,'missing':set()}
+	phx_catalogs[key]=catalog
+	return catalog
+
+def fetch_phoenix(this_file,source,fits_dir):
+	"""Copies one phoenix model from a URL (ftp://, http://, file://) or a directory into the local grid. The file is
+	written under a temporary name and renamed when it's complete, so an interrupted fetch never leaves half a file.
+	Inputs:
+	this_file
+		The phoenix .fits file
+	source
+		The URL or directory the model is in (with the metallicity), e.g. phx_source+'Z-0.0/'
+	fits_dir
+		The local directory to put it in (with the metallicity), e.g. phx_dir+'Z-0.0/'
+	
+	Outputs:
+	local_file
+		The path of the local copy
+	"""
+	import shutil
+	import urllib2
+	local_file=fits_dir+this_file
+	part_file=local_file+'.part{}'.format(os.getpid())
+	if not os.path.isdir(fits_dir):
+		try:
+			os.makedirs(fits_dir)
+		except OSError:
+			if not os.path.isdir(fits_dir): raise
+	try:
+		if os.path.isdir(source):
+			shutil.copyfile(os.path.join(source,this_file),part_file)
+		else:
+			inp=urllib2.urlopen(source+this_file)
+			with open(part_file,'wb') as out:
+				shutil.copyfileobj(inp,out,1<<20)
+			inp.close()
+		os.rename(part_file,local_file)
+	except (IOError,OSError) as err:
+		if os.path.isfile(part_file): os.remove(part_file)
+		raise IOError('Could not fetch {} from {}: {}'.format(this_file,source,err))
+	return local_file
+
+def reachable_phoenix(teff_range,logg_range,use_Z,tg_lists):
+	"""Lists the phoenix models that a run could need: every grid cell that brackets some T_eff and log(g) in the ranges.
+	Inputs:
+	teff_range
+		[lowest,highest] effective temperature on the surface of any model the run can try (so the equatorial
+		temperature of the coolest model up to the polar temperature of the hottest one)
+	logg_range
+		[lowest,highest] log of the surface gravity on the surface of any model the run can try
+	use_Z
+		The metallicity used for desired phoenix model spectra.
+	tg_lists
+		A list of lists with teff_list, logg_list, str_teff_list, and str_logg_list
+	
+	Outputs:
+	files
+		List of the phoenix .fits file names
+	"""
+	teff_list=np.array(tg_lists[0],dtype=float)
+	logg_list=np.array(tg_lists[1],dtype=float)
+	tlo,thi,tf=grid_bracket(teff_list,np.clip(np.array(teff_range,dtype=float),teff_list[0],teff_list[-1]))
+	glo,ghi,gf=grid_bracket(logg_list,np.clip(np.array(logg_range,dtype=float),logg_list[0],logg_list[-1]))
+	files=[]
+	for it in range(tlo[0],thi[-1]+1):
+		for ig in range(glo[0],ghi[-1]+1):
+			files.append('lte'+tg_lists[2][it]+tg_lists[3][ig]+use_Z[1:]+'.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits')
+	return files
+
+def prefetch_phoenix(phx_dir,use_Z,teff_range,logg_range,source=None,n_threads=8):
+	"""Fetches every phoenix model a run could need (see reachable_phoenix) that isn't already in phx_dir, several at
+	a time, so the run itself never has to stop and wait for one.
+	Inputs:
+	phx_dir
+		The directory the phoenix spectra are located in (without the metallicity). Fetched models are saved here.
+	use_Z
+		The metallicity used for desired phoenix model spectra.
+	teff_range
+		[lowest,highest] effective temperature on the surface of any model the run can try
+	logg_range
+		[lowest,highest] log of the surface gravity on the surface of any model the run can try
+	source
+		The URL or directory (without the metallicity) to fetch from. Defaults to phx_source.
+	n_threads
+		How many models to fetch at once
+	
+	Outputs:
+	fetched
+		List of the models that were fetched
+	failed
+		List of the models that couldn't be fetched
+	"""
+	from multiprocessing.pool import ThreadPool
+	if source is None:
+		source=phx_source
+	fits_dir=phx_dir+use_Z+'/'
+	teff_list,logg_list,str_teff_list,str_logg_list=phoenix_tg_lists()
+	files=reachable_phoenix(teff_range,logg_range,use_Z,[teff_list,logg_list,str_teff_list,str_logg_list])
+	have=set(phoenix_files(fits_dir))
+	to_fetch=[f for f in files if f not in have]
+	print '{} of the {} models needed are in {}. Fetching {} from {}'.format(len(files)-len(to_fetch),len(files),fits_dir,len(to_fetch),source+use_Z+'/')
+	def fetch(this_file):
+		try:
+			fetch_phoenix(this_file,source+use_Z+'/',fits_dir)
+		except IOError as err:
+			print err
+			return False
+		print 'Fetched {}'.format(this_file)
+		return True
+	fetched=[]
+	failed=[]
+	if len(to_fetch) > 0:
+		pool=ThreadPool(max(1,min(n_threads,len(to_fetch))))
+		done=pool.map(fetch,to_fetch)
+		pool.close()
+		pool.join()
+		for i in range(len(to_fetch)):
+			if done[i]:
+				fetched.append(to_fetch[i])
+			else:
+				failed.append(to_fetch[i])
+	phx_catalogs.clear()
+	return fetched,failed
 
+def warm_ranges(p,scale,m,beta,dist,mode,n_sigma=3.):
+	"""Works out the range of T_eff and log(g) on the surface of the star for any parameters within n_sigma*scale of p,
+	i.e. the part of the phoenix grid a chain starting at p with step sizes scale will need.
+	Inputs:
+	p
+		[R_e,vel,inc,T_p,pa] to start from
+	scale
+		The step sizes (standard deviations) of [R_e,vel,inc,T_p,pa]
+	m
+		The mass of the star in solar masses
+	beta
+		The gravity darkening coefficient (replaced if 'z' or 'r' is in mode)
+	dist
+		The distance to the star in parsecs
+	n_sigma
+		How many step sizes away from p to go
+	
+	Outputs:
+	teff_range
+		[lowest,highest] effective temperature
+	logg_range
+		[lowest,highest] log of the surface gravity
+	"""
+	import itertools
+	teffs=[]
+	loggs=[]
+	#The inclination and position angle don't change T_eff or log(g), so only R_e, vel, and T_p are varied
+	for dR,dv,dT in itertools.product([-1.,0.,1.],repeat=3):
+		q=[p[0]+dR*n_sigma*scale[0],max(p[1]+dv*n_sigma*scale[1],0.),p[2],p[3]+dT*n_sigma*scale[3],p[4]]
+		if q[0] <= 0.:
+			continue
+		try:
+			colat,phi,sin_colat,cos_colat,cos_phi,R_p,lomg,OMG,g_p,bet,R,tht_R,g,g_r,g_t,lg,T_eff,mu,x,y,z=surface_grid(q,m,beta,dist,20,2,mode)
+		except (ValueError,FloatingPointError,ZeroDivisionError):
+			continue
+		T_eff=np.asarray(T_eff)[np.isfinite(T_eff)]
+		lg=np.asarray(lg)[np.isfinite(lg)]
+		if len(T_eff) > 0 and len(lg) > 0:
+			teffs+=[np.amin(T_eff),np.amax(T_eff)]
+			loggs+=[np.amin(lg),np.amax(lg)]
+	return [min(teffs),max(teffs)],[min(loggs),max(loggs)]
+
+def warm_init(fits_dir,mode,wl_list):
+	"""Sets up a warm_phoenix worker process"""
+	warm_setup['fits_dir']=fits_dir
+	warm_setup['mode']=mode
+	warm_setup['wl_list']=wl_list
+
+def warm_cell(this_file):
+	"""Reads and band integrates one phoenix model in a warm_phoenix worker process
+	Inputs:
+	this_file
+		The phoenix .fits file
+	
+	Outputs:
+	this_file
+		The phoenix .fits file
+	this_file_entry
+		The entry this file will have in phx_dict
+	read_time
+		How long reading the model took (s)
+	filter_time
+		How long integrating it over the bands took (s)
+	"""
+	mode=warm_setup['mode']
+	start=time.time()
+	this_arr,this_mu=open_phoenix(warm_setup['fits_dir'],this_file)
+	this_arr=np.array(this_arr)
+	read_time=time.time()-start
+	start=time.time()
+	phx_mu=np.concatenate((np.array([0.]),this_mu))
+	phx_wav=(np.arange(np.shape(this_arr)[1])+500.)*1e-8
+	phot_filtered,vis_filtered=filter_phoenix(this_arr,phx_mu,phx_wav,mode,warm_setup['wl_list'])
+	filter_time=time.time()-start
+	if not full_spectra(mode):
+		this_arr=None
+	return this_file,[this_arr,phot_filtered,vis_filtered],read_time,filter_time
+
+def warm_phoenix(phx_dir,use_Z,phx_dict,mode,wl_list,teff_range,logg_range,n_procs=None):
+	"""Loads every phoenix model in a T_eff/log(g) range into phx_dict before a run starts (see warm_ranges), reading
+	and band integrating them in parallel over n_procs processes, and prints how long each one took. Models that
+	aren't available locally are fetched into phx_dir first (see prefetch_phoenix).
+	Inputs:
+	phx_dir
+		The directory the phoenix spectra are located in (without the metallicity)
+	use_Z
+		The metallicity used for desired phoenix model spectra.
+	phx_dict
+		A dictionary with all the saved phoenix spectra in it. The models get added to it.
+	mode
+		The mode string
+	wl_list
+		[use_filts,filt_dict,uni_wl,uni_dwl]
+	teff_range
+		[lowest,highest] effective temperature
+	logg_range
+		[lowest,highest] log of the surface gravity
+	n_procs
+		The number of processes to use (defaults to the number of cores)
+	
+	Outputs:
+	timing
+		Dictionary with [read time, band integration time] (in s) of every model that was loaded
+	"""
+	import multiprocessing
+	fits_dir=phx_dir+use_Z+'/'
+	tg_lists=list(phoenix_tg_lists())
+	if phx_mirror:
+		prefetch_phoenix(phx_dir,use_Z,teff_range,logg_range)
+	catalog=phoenix_catalog(phx_dir,use_Z,tg_lists,mode,wl_list)
+	files=[f for f in reachable_phoenix(teff_range,logg_range,use_Z,tg_lists) if not phx_dict.get(f) and f in catalog['local']]
+	
+	start=time.time()
+	timing=dict()
+	to_read=[]
+	for this_file in files:
+		bands=cached_bands(this_file,fits_dir,wl_list)
+		if bands is not None and not full_spectra(mode):
+			phx_dict[this_file]=[None,bands[0],bands[1]]
+			phoenix_cache(this_file,phx_dict,mode)
+		else:
+			to_read.append(this_file)
+	if len(to_read) > 0:
+		if n_procs is None:
+			n_procs=multiprocessing.cpu_count()
+		pool=multiprocessing.Pool(max(1,min(n_procs,len(to_read))),warm_init,(fits_dir,mode,wl_list))
+		for this_file,this_entry,read_time,filter_time in pool.imap_unordered(warm_cell,to_read):
+			phx_dict[this_file]=this_entry
+			phoenix_cache(this_file,phx_dict,mode)
+			timing[this_file]=[read_time,filter_time]
+			print '{}: read {:.3f} s, integrated {:.3f} s'.format(this_file,read_time,filter_time)
+		pool.close()
+		pool.join()
+	print 'Warmed up {} phoenix models ({} read, {} from precomputed bands) in {:.2f} s'.format(len(files),len(to_read),len(files)-len(to_read),time.time()-start)
+	return timing
 
 def read_this_phoenix(this_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list):
 	"""Reads the phoenix model spectra and sets up phx_dict dictionary.
@@ -1624,50 +2715,17 @@ def read_this_phoenix(this_file,phx_dict,phx_dir,phx_mu,phx_wav,mode,wl_list):
 	this_file_entry
 		The entry this file will have in the phx_dict
 	"""
+	#The full spectrum is only needed for luminosities and plots, so if the band integrals are already done, that's all
+	bands=cached_bands(this_file,phx_dir,wl_list)
+	if bands is not None and not full_spectra(mode):
+		phx_dict[this_file] = [None,bands[0],bands[1]]
+		return phx_dict[this_file]
 	#print 'Grabbing file {} from {}'.format(tlo_str+glo_str,'this Computer')
 	print 'Grabbing this file from the Computer: {}'.format(this_file)
-	this_hdulist = pyfits.open(phx_dir+this_file)
-	this_arr=this_hdulist[0].data
-	this_hdulist.close()
-	
-	use_filts=wl_list[0]
-	filt_dict=wl_list[1]
-	uni_wl=wl_list[2]
-	uni_dwl=wl_list[3]
-		
+	this_arr,this_mu=open_phoenix(phx_dir,this_file)
 	
-	phot_filtered=[]
-	if 'p' in mode:
-		for i in range(len(use_filts)):
-			inted=[]
-			for j in np.arange(len(phx_mu)-1)+1:
-				#non_inted is the filtered (i.e., had a filter response curve applied to it), non-integrated version of the intensity array 
-				not_inted=this_arr[j-1,:]*filt_dict[use_filts[i]]/fwhm(phx_wav,filt_dict[use_filts[i]])/1e8
-				#inted is non_inted that has been integrated over wavelength
-				#inted.append(np.trapz(not_inted,x=phx_wav))
-				not_inted_reduced = not_inted[np.where(filt_dict[use_filts[i]] > 0)]
-				#inted is non_inted_reduced that has been integrated over wavelength
-				inted.append(do_phx_integrate(not_inted_reduced))
-			phot_filtered.append(inted)
-	
-	vis_filtered=[]
-	if 'v' in mode:
-		for i in range(len(uni_wl)):
-			inted=[]
-			the_filter=np.zeros(len(phx_wav))
-			for k in range(len(phx_wav)):
-				#This creates a top-hat function for the filter response curve of the visibility observations
-				if phx_wav[k]/100. > uni_wl[i]-uni_dwl[i]/2. and phx_wav[k]/100. <= uni_wl[i]+uni_dwl[i]/2.:
-					the_filter[k]=1.
-			for j in np.arange(len(phx_mu)-1)+1:
-				#non_inted is the filtered (i.e., had a filter response curve applied to it), non-integrated version of the intensity array 
-				not_inted=this_arr[j-1,:]*the_filter/uni_dwl[i]
-				#inted is non_inted that has been integrated over wavelength
-				#inted.append(np.trapz(not_inted,x=phx_wav))
-				not_inted_reduced = not_inted[np.where(not_inted > 0)]
-				#inted is non_inted_reduced that has been integrated over wavelength
-				inted.append(do_phx_integrate(not_inted_reduced))
-			vis_filtered.append(inted)
+	phot_filtered,vis_filtered=filter_phoenix(this_arr,phx_mu,phx_wav,mode,wl_list)
+
 	phx_dict[this_file] = [this_arr,phot_filtered,vis_filtered]
 	return [this_arr,phot_filtered,vis_filtered]
 def read_this_phoenix_ftp(this_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list):
@@ -1704,44 +2762,8 @@ def read_this_phoenix_ftp(this_file,phx_dict,ftp_dir,phx_mu,phx_wav,mode,wl_list
 	this_arr=this_hdulist[0].data
 	this_hdulist.close()
 	
-	use_filts=wl_list[0]
-	filt_dict=wl_list[1]
-	uni_wl=wl_list[2]
-	uni_dwl=wl_list[3]
-		
-	
-	phot_filtered=[]
-	if 'p' in mode:
-		for i in range(len(use_filts)):
-			inted=[]
-			for j in np.arange(len(phx_mu)-1)+1:
-				#non_inted is the filtered (i.e., had a filter response curve applied to it), non-integrated version of the intensity array 
-				not_inted=this_arr[j-1,:]*filt_dict[use_filts[i]]/fwhm(phx_wav,filt_dict[use_filts[i]])/1e8
-				#inted is non_inted that has been integrated over wavelength
-				#inted.append(np.trapz(not_inted,x=phx_wav))
-				not_inted_reduced = not_inted[np.where(filt_dict[use_filts[i]] > 0)]
-				#inted is non_inted_reduced that has been integrated over wavelength
-				inted.append(do_phx_integrate(not_inted_reduced))
-			phot_filtered.append(inted)
-	
-	vis_filtered=[]
-	if 'v' in mode:
-		for i in range(len(uni_wl)):
-			inted=[]
-			the_filter=np.zeros(len(phx_wav))
-			for k in range(len(phx_wav)):
-				#This creates a top-hat function for the filter response curve of the visibility observations
-				if phx_wav[k]/100. > uni_wl[i]-uni_dwl[i]/2. and phx_wav[k]/100. <= uni_wl[i]+uni_dwl[i]/2.:
-					the_filter[k]=1.
-			for j in np.arange(len(phx_mu)-1)+1:
-				#non_inted is the filtered (i.e., had a filter response curve applied to it), non-integrated version of the intensity array 
-				not_inted=this_arr[j-1,:]*the_filter/uni_dwl[i]
-				#inted is non_inted that has been integrated over wavelength
-				#inted.append(np.trapz(not_inted,x=phx_wav))
-				not_inted_reduced = not_inted[np.where(not_inted > 0)]
-				#inted is non_inted_reduced that has been integrated over wavelength
-				inted.append(do_phx_integrate(not_inted_reduced))
-			vis_filtered.append(inted)
+	phot_filtered,vis_filtered=filter_phoenix(this_arr,phx_mu,phx_wav,mode,wl_list)
+
 	phx_dict[this_file] = [this_arr,phot_filtered,vis_filtered]
 	return [this_arr,phot_filtered,vis_filtered]
 
@@ -1877,7 +2899,7 @@ def amoeba(var,scale,func,ftolerance=1.e-4,xtolerance=1.e-4,itmax=500,data=None)
         fvalue[ssworst] = fnew
         iteration += 1
         #if __debug__: print ssbest,fvalue[ssbest]
-def calc_vis(r,R_p,beta,dist,lomg,OMG,m,vis,vis_err,wl,u_l,v_l,u_m,v_m,uni_wl,g_scale,perim_x,perim_y,n_params,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list,cal,y_above,x_above,star,model,model_dir):
+def calc_vis(r,R_p,beta,dist,lomg,OMG,m,vis,vis_err,wl,u_l,v_l,u_m,v_m,uni_wl,perim_x,perim_y,n_params,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list,cal,y_above,x_above,star,model,model_dir):
 	"""Calculates the visibility
 	Inputs:
 	vis
@@ -1886,8 +2908,6 @@ def calc_vis(r,R_p,beta,dist,lomg,OMG,m,vis,vis_err,wl,u_l,v_l,u_m,v_m,uni_wl,g_
 		The uncertainties in the measured visibilities
 	uni_wl
 		The unique wavelengths associated with the observed visibilities
-	g_scale
-		The scale required such that ~1000 of the pixels in the model image are of the star
 	perim_x
 		x coordinates that make up the perimeter of the star
 	perim_y
@@ -1899,139 +2919,95 @@ def calc_vis(r,R_p,beta,dist,lomg,OMG,m,vis,vis_err,wl,u_l,v_l,u_m,v_m,uni_wl,g_
 	vis_chi2
 		The chi^2 value comparing the observed and modeled visibilities.
 	"""
+	mod_vis,g_points=model_vis(r,R_p,beta,dist,lomg,OMG,m,wl,u_l,v_l,uni_wl,perim_x,perim_y,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list)
+	if mod_vis is None:
+		return 1e8,0
+	if 'V' in mode:
+		validate_vis(r,R_p,beta,dist,lomg,OMG,m,vis,vis_err,wl,u_l,v_l,uni_wl,perim_x,perim_y,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list)
+	#print 'Visibilities took {} seconds'.format(vis_time)
+	diff_vis=vis-mod_vis	#Observed minus modeled
+	bol=np.sqrt(u_l**2.+v_l**2.)	#B/lambda, the 1D spatial frequency
+	
+	#plt.plot(bol,vis,'ro')
+	#plt.plot(bol,mod_vis,'bs')
+	#plt.show()
+	
+	if 'P' in mode:
+		plot_ellipse(vis,vis_err,bol,u_m,v_m,cal,y_above,x_above,star,model,model_dir)
+		plot_vis(vis,vis_err,mod_vis,diff_vis,bol,star,model,model_dir)
+	
+	vis_chi2=sum(diff_vis**2./vis_err**2.)/(float(len(diff_vis))-n_params-1.)	#The chi^2 based on the visibilities
+	return vis_chi2,g_points
+
+def model_vis(r,R_p,beta,dist,lomg,OMG,m,wl,u_l,v_l,uni_wl,perim_x,perim_y,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list):
+	"""Calculates the model visibilities at the observed (u,v) points
+	If 'n' is in mode, the Fourier transform of the model image is evaluated directly at the observed (u,v) points
+	(see direct_vis). Otherwise the whole model image gets an FFT and the visibilities are interpolated off of that.
+	Inputs:
+	wl
+		The wavelength of each of the observed visibilities
+	u_l
+		The u coordinates (in wavelengths) of the observed visibilities
+	v_l
+		The v coordinates (in wavelengths) of the observed visibilities
+	uni_wl
+		The unique wavelengths associated with the observed visibilities
+	perim_x
+		x coordinates that make up the perimeter of the star
+	perim_y
+		y coordinates that make up the perimeter of the star
+	
+	Outputs:
+	mod_vis
+		The model visibilities (None if something went wrong making the model image)
+	g_points
+		The number of pixels of the model image that are on the star
+	"""
 	R_e,V_e,inc,T_p,pa=r
-	#res=4900 #This sets the size of the model image (i.e. the image is an array of size res+1 x res+1)
-	res=4095
-	#res=4899
-	
-	mod_vis=np.zeros(len(vis))
-	bl=np.arange(res+1.) #Baseline in meters
-	bl*=g_scale
-	vis_time=0.
+	dlin=image_grid(perim_x,perim_y,u_l,v_l) #This sets the scale and size of the image
+	res=len(dlin)-1
+	
+	mod_vis=np.zeros(len(wl))
+	#The geometry of the image is the same at every wavelength, so finding the pixels on the star, what part of the
+		#surface each of them sees, and their intensities at every wavelength (from one interpolation of the phoenix
+		#intensity cube) is all done once here. Each wavelength's image is then just a row of pix_ints.
+	try:
+		yi,xi,tht_xyz,phi_xyz,mu,T_eff,lg,converged=render_image(dlin,perim_x,perim_y,inc,R_e,T_p,beta,R_p,dist,lomg,OMG,m,pa)
+		cube=phoenix_cube(T_eff,lg,'vis',phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list)
+		pix_ints=interp_cube(cube,T_eff,lg,mu)	#(wavelength x pixel)
+	except:
+		print 'An error occured making the model image. Returning with high chi^2.'
+		return None,0
+	g_points=len(yi)
+	if 'o' in mode and not converged.all():
+		print '{} of {} pixels only graze the surface of the star'.format(len(yi)-converged.sum(),len(yi))
+	
 	for index in range(len(uni_wl)):
 		image_start=time.time()
-		intensity_array=np.zeros((res+1,res+1),dtype=np.complex64) #This will be where the model image gets stored
-		dlin=unitrange(res)*uni_wl[index]-uni_wl[index]/2. #This sets the scale of the image
-		dlin/=g_scale
-		
-		#This next bit goes through the model image, line by line (for each quadrant of the star) and first checks
-			#if the point is inside the star's perimeter (defined earlier). If it is, it will calculate the flux at that 
-			#point with the extract function. If it's not, it will move to the next line. 
-		g_points=0
-		#Top Half
-		yi=res/2
-		yj=True
-		while yj:
-			#print yi
-			#Right Side
-			xi=res/2
-			xj=True
-			ilist=[]
-			while xj:
-				if inside.inside(dlin[xi],dlin[yi],perim_x,perim_y):
-					try:
-						iii=extract(dlin[xi],dlin[yi],inc,R_e,T_p,beta,R_p,dist,lomg,OMG,m,pa,index,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list)
-					except:
-						print 'An error occured in extract(1). Returning with high chi^2.'
-						return 1e8,0
-					intensity_array[yi,xi]=iii
-					ilist.append(iii)
-					xi+=1
-					g_points+=1
-				else:
-					xj=False
-			#Left Side
-			xi=res/2-1
-			xj=True
-			ilist=[]
-			while xj:
-				if inside.inside(dlin[xi],dlin[yi],perim_x,perim_y):
-					try:
-						iii=extract(dlin[xi],dlin[yi],inc,R_e,T_p,beta,R_p,dist,lomg,OMG,m,pa,index,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list)
-					except:
-						print 'An error occured in extract(2). Returning with high chi^2.'
-						return 1e8,0
-					intensity_array[yi,xi]=iii
-					ilist.append(iii)
-					xi-=1
-					g_points+=1
-				else:
-					xj=False
-			if ilist == []:
-				yj=False
-			else:
-				yi+=1
-		#Bottom Half
-		yi=res/2-1
-		yj=True
-		while yj:
-			#print yi
-			#Right Side
-			xi=res/2
-			xj=True
-			ilist=[]
-			while xj:
-				if inside.inside(dlin[xi],dlin[yi],perim_x,perim_y):
-					try:
-						iii=extract(dlin[xi],dlin[yi],inc,R_e,T_p,beta,R_p,dist,lomg,OMG,m,pa,index,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list)
-					except:
-						print 'An error occured in extract(3). Returning with high chi^2.'
-						return 1e8,0
-					intensity_array[yi,xi]=iii
-					ilist.append(iii)
-					xi+=1
-					g_points+=1
-				else:
-					xj=False
-			#Left Side
-			xi=res/2-1
-			xj=True
-			ilist=[]
-			while xj:
-				if inside.inside(dlin[xi],dlin[yi],perim_x,perim_y):
-					try:
-						iii=extract(dlin[xi],dlin[yi],inc,R_e,T_p,beta,R_p,dist,lomg,OMG,m,pa,index,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list)
-					except:
-						print 'An error occured in extract(4). Returning with high chi^2.'
-						return 1e8,0
-					intensity_array[yi,xi]=iii
-					ilist.append(iii)
-					xi-=1
-					g_points+=1
-				else:
-					xj=False
-			if ilist == []:
-				yj=False
-			else:
-				yi-=1
+		pix_int=pix_ints[index]
 		
-		intensity_array/=np.amax(intensity_array) #Normalize the intensity array
+		if 'n' in mode:
+			#Evaluate the transform of the image right at the observed (u,v) points instead of doing the FFT
+			this_wl=np.where(wl == uni_wl[index])[0]
+			mod_vis[this_wl]=direct_vis(pix_int,dlin[xi],dlin[yi],u_l[this_wl],v_l[this_wl])
+			continue
+		plan=fft_setup((res+1,res+1),mode)
+		intensity_array=plan['image'] #This is where the model image gets stored. It's kept between calls, so clear it first.
+		intensity_array.fill(0.)
+		intensity_array[yi,xi]=pix_int
 		image_finish=time.time()
 		image_time=image_finish-image_start
 		#print 'Image generation took {} seconds'.format(image_time)
-		#print 'Scale: {}, Number of points: {}'.format(g_scale,g_points)
+		#print 'Pixel size: {} mas, Image size: {}, Number of points: {}'.format((dlin[1]-dlin[0])*206264806.,res+1,g_points)
 		fft_start=time.time()	#To calculate how long the fft takes to compute
 		#=====================#
 		#    FFT DONE HERE    #
 		#=====================#
-		if 'g' not in mode:
-			v=np.fft.fft2(intensity_array)	#Does the actual transform
-		if 'g' in mode:
-			cuda.init()
-			context=make_default_context()
-			stream=cuda.Stream()
-			plan=Plan((res+1,res+1),stream=stream)
-			gpu_data=gpuarray.to_gpu(intensity_array)
-			plan.execute(gpu_data)
-			v=gpu_data.get()
-			context.pop()
+		v=image_fft(plan)	#Does the actual transform. The image is real, so only the v >= 0 half of the plane comes back.
 		
 		fft_finish=time.time()	#To calculate how long the fft takes to compute
 		fft_time=fft_finish-fft_start	#To calculate how long the fft takes to compute
 		#print 'FFT took {} seconds'.format(fft_time)
-		v=abs(v)	#Only use real component
-		v/=np.amax(v)	#Normalize
-		
 		
 		#imgplot=plt.imshow(intensity_array,cmap=cm.gray)
 		#plt.show()
@@ -2039,84 +3015,249 @@ def calc_vis(r,R_p,beta,dist,lomg,OMG,m,vis,vis_err,wl,u_l,v_l,u_m,v_m,uni_wl,g_
 		#plt.show()
 		
 		
-		sf=bl/uni_wl[index]-max(bl)/uni_wl[index]/2.	#The spatial frequency vector
-		sf_ind=np.arange(len(sf))	#The indicies of the spatial frequency vector
-		#This for loop extracts the visibility at the measured spatial frequencies (u_l and v_l)
-		#vis_start=time.time()
-		for i in range(len(vis)):
-			if wl[i] == uni_wl[index]:
-				#Bilinear interpolation time
-				geu=sf[np.where(sf >= u_l[i])]
-				leu=sf[np.where(sf <= u_l[i])]
-				ulo=max(leu)
-				uhi=min(geu)
-				gev=sf[np.where(sf >= v_l[i])]
-				lev=sf[np.where(sf <= v_l[i])]
-				vlo=max(lev)
-				vhi=min(gev)
-				
-				ui=sf_ind[np.where(sf == ulo)]
-				vi=sf_ind[np.where(sf == vlo)]
-				if u_l[i] < 0:
-					ui+=res/2
-				else:
-					ui-=res/2
-				if v_l[i] < 0:
-					vi+=res/2
-				else:
-					vi-=res/2
-				ll=v[ui,vi]
-				ui=sf_ind[np.where(sf == uhi)]
-				vi=sf_ind[np.where(sf == vlo)]
-				if u_l[i] < 0:
-					ui+=res/2
-				else:
-					ui-=res/2
-				if v_l[i] < 0:
-					vi+=res/2
-				else:
-					vi-=res/2
-				hl=v[ui,vi]
-				ui=sf_ind[np.where(sf == ulo)]
-				vi=sf_ind[np.where(sf == vhi)]
-				if u_l[i] < 0:
-					ui+=res/2
-				else:
-					ui-=res/2
-				if v_l[i] < 0:
-					vi+=res/2
-				else:
-					vi-=res/2
-				lh=v[ui,vi]
-				ui=sf_ind[np.where(sf == uhi)]
-				vi=sf_ind[np.where(sf == vhi)]
-				if u_l[i] < 0:
-					ui+=res/2
-				else:
-					ui-=res/2
-				if v_l[i] < 0:
-					vi+=res/2
-				else:
-					vi-=res/2
-				hh=v[ui,vi]
-				int_v=ll/(uhi-ulo)/(vhi-vlo)*(uhi-u_l[i])*(vhi-v_l[i])+hl/(uhi-ulo)/(vhi-vlo)*(u_l[i]-ulo)*(vhi-v_l[i])+lh/(uhi-ulo)/(vhi-vlo)*(uhi-u_l[i])*(v_l[i]-vlo)+hh/(uhi-ulo)/(vhi-vlo)*(u_l[i]-ulo)*(v_l[i]-vlo)
-				mod_vis[i]=int_v[0]
-				#vis_finish=time.time()
-				#vis_time+=vis_finish-vis_start
-	#print 'Visibilities took {} seconds'.format(vis_time)
-	diff_vis=vis-mod_vis	#Observed minus modeled
-	bol=np.sqrt(u_l**2.+v_l**2.)	#B/lambda, the 1D spatial frequency
+		#Extract the visibility at the measured spatial frequencies (u_l and v_l)
+		this_wl=np.where(wl == uni_wl[index])[0]
+		mod_vis[this_wl]=lookup_vis(v,dlin[1]-dlin[0],u_l[this_wl],v_l[this_wl])
+	return mod_vis,g_points
+
+def direct_vis(intensity,tht_x,tht_y,u,v):
+	"""Calculates the visibility by summing the Fourier transform of the model image over just the pixels on the star,
+	right at the supplied (u,v) points. There's no gridding, so there's no interpolation error either.
+	As with the FFT, u goes with the y axis of the image and v goes with the x axis.
+	Inputs:
+	intensity
+		Array of the intensities of the pixels on the star
+	tht_x
+		Array of the x coordinates (in radians) of those pixels
+	tht_y
+		Array of the y coordinates (in radians) of those pixels
+	u
+		Array of the u coordinates (in wavelengths) to get the visibility at
+	v
+		Array of the v coordinates (in wavelengths) to get the visibility at
 	
-	#plt.plot(bol,vis,'ro')
-	#plt.plot(bol,mod_vis,'bs')
-	#plt.show()
+	Outputs:
+	vis
+		Array of the visibilities (normalized to 1 at zero spatial frequency)
+	"""
+	phase=-2.*np.pi*(np.outer(u,tht_y)+np.outer(v,tht_x))
+	re=np.dot(np.cos(phase),intensity)
+	im=np.dot(np.sin(phase),intensity)
+	return np.sqrt(re**2.+im**2.)/np.sum(intensity)
+
+def image_grid(perim_x,perim_y,u_l,v_l):
+	"""Works out the pixel size and number of pixels of the model image from the size of the star and the
+	largest spatial frequency that was observed.
+	The pixel size is set so that ~vis_pixels pixels land on the star, and so there are at least 4 pixels across
+	the finest fringe (1/max(|u|,|v|)). The number of pixels sets the spacing of the FFT's bins, 1/(N*pitch).
+	lookup_vis interpolates the complex transform (about the center of the star) bilinearly between bins, which is off
+	by at most (pi/(N*pitch))^2*<x^2+y^2>/2, where <x^2+y^2> is the intensity weighted mean of the squared distance from
+	the center. That's theta^2/8 for a uniform disk theta across, and limb darkening only makes it smaller, so
+	(pi*theta/(N*pitch))^2/16 is kept under vis_accuracy. Unlike |V|, the complex transform is smooth through the
+	nulls, so this holds at every baseline. N is then rounded up to a size that FFTs are fast for.
+	Inputs:
+	perim_x
+		x coordinates (in radians) that make up the perimeter of the star
+	perim_y
+		y coordinates (in radians) that make up the perimeter of the star
+	u_l
+		The u coordinates (in wavelengths) of the observed visibilities
+	v_l
+		The v coordinates (in wavelengths) of the observed visibilities
 	
-	if 'P' in mode:
-		plot_ellipse(vis,vis_err,bol,u_m,v_m,cal,y_above,x_above,star,model,model_dir)
-		plot_vis(vis,vis_err,mod_vis,diff_vis,bol,star,model,model_dir)
+	Outputs:
+	dlin
+		The coordinates (in radians) of the centers of the pixels along each axis of the model image
+	"""
+	area=0.5*abs(np.dot(perim_x,np.roll(perim_y,1))-np.dot(perim_y,np.roll(perim_x,1)))	#Shoelace formula
+	pitch=np.sqrt(area/vis_pixels)
+	f_max=max(np.amax(abs(u_l)),np.amax(abs(v_l)))
+	if f_max > 0.:
+		pitch=min(pitch,0.25/f_max)
+	theta=max(np.amax(perim_x)-np.amin(perim_x),np.amax(perim_y)-np.amin(perim_y))	#Angular size of the star
+	n_fit=2.*max(np.amax(abs(perim_x)),np.amax(abs(perim_y)))/pitch+2.	#Enough pixels to fit the whole star
+	n_acc=np.pi*theta/(4.*np.sqrt(vis_accuracy)*pitch)
+	n=fft_size(int(np.ceil(max(n_fit,n_acc))))
+	return (np.arange(n)-(n-1.)/2.)*pitch
+
+def fft_size(n):
+	"""Returns the smallest even number >= n that has no prime factors other than 2, 3, and 5 (FFTs of those are fast)."""
+	best=2
+	while best < n:
+		best*=2
+	p5=1
+	while p5 < best:
+		p35=p5
+		while p35 < best:
+			p2=2
+			while p2*p35 < n:
+				p2*=2
+			best=min(best,p2*p35)
+			p35*=3
+		p5*=5
+	return best
+
+def lookup_vis(ft,pitch,u,v):
+	"""Bilinearly interpolates the visibility at the supplied (u,v) points off of the FFT of the model image.
+	The FFT's bins sit at exactly k/(N*pitch) for an N pixel wide image, so that's where they're interpolated from.
+	The FFT puts the origin at the corner of the image, which multiplies the transform by a phase ramp that winds
+	once per bin. That gets taken back out of the bins used (putting the origin at the center of the star), then the
+	complex transform is interpolated and the amplitude taken last, since |V| has a kink at each null and the
+	complex transform doesn't.
+	Inputs:
+	ft
+		The FFT of the model image (from image_fft). Rows go with u (the y axis of the image) and columns are the
+		v >= 0 half of the plane (the x axis).
+	pitch
+		The size of a pixel of the model image in radians
+	u
+		Array of the u coordinates (in wavelengths) to get the visibility at
+	v
+		Array of the v coordinates (in wavelengths) to get the visibility at
 	
-	vis_chi2=sum(diff_vis**2./vis_err**2.)/(float(len(diff_vis))-n_params-1.)	#The chi^2 based on the visibilities
-	return vis_chi2,g_points
+	Outputs:
+	vis
+		Array of the visibilities, normalized to 1 at zero spatial frequency
+	"""
+	n_y=ft.shape[0]
+	n_x=2*(ft.shape[1]-1)
+	flip=np.where(v < 0,-1.,1.)	#The image is real, so the visibility at (u,v) is the conjugate of the one at (-u,-v)
+	ku=u*flip*n_y*pitch	#The (u,v) points in units of FFT bins
+	kv=v*flip*n_x*pitch
+	ulo=np.floor(ku).astype(int)
+	vlo=np.floor(kv).astype(int)
+	du=ku-ulo
+	dv=kv-vlo
+	
+	def centered(iu,iv):
+		#The transform at bin (iu,iv) (iu can be negative) about the center of the image, (N-1)/2 pixels in
+		return ft[iu%n_y,iv]*np.exp(np.pi*1j*(iu*(n_y-1.)/n_y+iv*(n_x-1.)/n_x))
+	
+	vis=centered(ulo,vlo)*(1.-du)*(1.-dv)+centered(ulo+1,vlo)*du*(1.-dv)+centered(ulo,vlo+1)*(1.-du)*dv+centered(ulo+1,vlo+1)*du*dv
+	return abs(vis)/abs(ft[0,0])
+
+def fft_setup(shape,mode):
+	"""Gets the image buffer and FFT plan used to transform a real model image of the given shape.
+	These are made the first time they're asked for and kept in fft_plans after that, so the FFTW plan, the GPU context,
+	and the pyfft plan are only made once no matter how many wavelengths or models get transformed.
+	Inputs:
+	shape
+		The shape of the model image
+	mode
+		If 'g' is in mode, the transform is done on the GPU. Otherwise fft_lib says which library does it.
+	
+	Outputs:
+	plan
+		Dictionary holding the library used ('lib'), the float32 image buffer to fill in ('image'),
+		and whatever else that library needs to do the transform
+	"""
+	if 'g' in mode:
+		lib='gpu'
+	elif fft_lib == 'auto':
+		if 'auto' not in fft_plans:
+			fft_plans['auto']=pick_fft_lib()
+		lib=fft_plans['auto']
+	else:
+		lib=fft_lib
+	if lib not in ['numpy','scipy','fftw','gpu']:
+		print "Unknown fft_lib '{}'. Using numpy instead.".format(lib)
+		lib='numpy'
+	key=(lib,shape,fft_threads)
+	if key in fft_plans:
+		return fft_plans[key]
+	
+	plan={'lib':lib}
+	if lib == 'fftw':
+		import pyfftw
+		plan['image']=pyfftw.empty_aligned(shape,dtype='float32')
+		out=pyfftw.empty_aligned((shape[0],shape[1]/2+1),dtype='complex64')
+		plan['fft']=pyfftw.FFTW(plan['image'],out,axes=(0,1),threads=fft_threads,flags=('FFTW_MEASURE',))
+	elif lib == 'gpu':
+		import pycuda.autoinit	#Makes the context (once)
+		import pycuda.driver as cuda
+		import pycuda.gpuarray as gpuarray
+		from pyfft.cuda import Plan
+		plan['image']=np.zeros(shape,dtype=np.float32)
+		stream=cuda.Stream()
+		plan['fft']=Plan(shape,stream=stream)
+		plan['gpu_data']=gpuarray.empty(shape,np.complex64)
+	else:
+		plan['image']=np.zeros(shape,dtype=np.float32)
+	fft_plans[key]=plan
+	return plan
+
+def pick_fft_lib():
+	"""Picks the fastest FFT library that is installed: pyFFTW, then scipy.fft (scipy >= 1.4), then numpy."""
+	try:
+		import pyfftw
+		return 'fftw'
+	except ImportError:
+		pass
+	try:
+		import scipy.fft
+		return 'scipy'
+	except ImportError:
+		return 'numpy'
+
+def image_fft(plan):
+	"""Fourier transforms the model image held in plan['image'] (see fft_setup).
+	The image is real, so only the non-negative half of the frequencies along the second axis is computed
+	(the rest are complex conjugates), which halves both the memory and the work.
+	Inputs:
+	plan
+		The plan from fft_setup, with the model image filled in
+	
+	Outputs:
+	v
+		The transform of the image, of shape (N_y,N_x/2+1)
+	"""
+	lib=plan['lib']
+	if lib == 'fftw':
+		return plan['fft']()
+	elif lib == 'scipy':
+		import scipy.fft
+		return scipy.fft.rfft2(plan['image'],workers=fft_threads)
+	elif lib == 'gpu':
+		#pyfft only does complex to complex transforms, so keep the half that the CPU libraries would give
+		gpu_data=plan['gpu_data']
+		gpu_data.set(plan['image'].astype(np.complex64))
+		plan['fft'].execute(gpu_data)
+		return gpu_data.get()[:,:plan['image'].shape[1]/2+1]
+	else:
+		return np.fft.rfft2(plan['image'])
+
+def validate_vis(r,R_p,beta,dist,lomg,OMG,m,vis,vis_err,wl,u_l,v_l,uni_wl,perim_x,perim_y,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list):
+	"""Calculates the model visibilities both with the FFT and by evaluating the Fourier transform directly at the
+	observed (u,v) points (see model_vis) and prints how they compare.
+	Inputs:
+	Same as model_vis, plus
+	vis
+		The measured visibilities
+	vis_err
+		The uncertainties in the measured visibilities
+	
+	Outputs:
+	fft_vis
+		The model visibilities from the FFT
+	dft_vis
+		The model visibilities from the direct transform
+	"""
+	fft_mode=mode.replace('n','')
+	start=time.time()
+	fft_vis,g_points=model_vis(r,R_p,beta,dist,lomg,OMG,m,wl,u_l,v_l,uni_wl,perim_x,perim_y,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,fft_mode,wl_list)
+	fft_time=time.time()-start
+	start=time.time()
+	dft_vis,g_points=model_vis(r,R_p,beta,dist,lomg,OMG,m,wl,u_l,v_l,uni_wl,perim_x,perim_y,phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,fft_mode+'n',wl_list)
+	dft_time=time.time()-start
+	if fft_vis is None or dft_vis is None:
+		print 'validate_vis: the model image could not be made'
+		return fft_vis,dft_vis
+	diff=fft_vis-dft_vis
+	print 'validate_vis: FFT took {} s, direct took {} s ({} pixels on the star)'.format(fft_time,dft_time,g_points)
+	print 'validate_vis: max |V_fft-V_direct|: {}, rms: {}, max |V_fft-V_direct|/vis_err: {}'.format(np.amax(abs(diff)),np.sqrt(np.mean(diff**2.)),np.amax(abs(diff)/vis_err))
+	print 'validate_vis: chi^2 (FFT): {}, chi^2 (direct): {}'.format(sum((vis-fft_vis)**2./vis_err**2.),sum((vis-dft_vis)**2./vis_err**2.))
+	return fft_vis,dft_vis
+
 def calc_phot(r,R,tht_R,T_eff,g,g_r,g_t,lg,OMG,phot_data,colat,phi,sin_colat,cos_colat,cos_phi,sin_inc,cos_inc,filt_dict,use_filts,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,zpf,cwl,mode,wl_list,n_params,star,model,model_dir):
 	"""Calculates the photometry
 	Inputs:
@@ -2127,29 +3268,23 @@ def calc_phot(r,R,tht_R,T_eff,g,g_r,g_t,lg,OMG,phot_data,colat,phi,sin_colat,cos
 	"""
 	R_e,V_e,inc,T_p,pa=r
 	#Calculating Photometry
-	phot_phi=dict()
-	for f in filt_dict:
-		phot_phi[f]=[]
-	for j in range(len(phi)):
-		phot_col=dict()
-		for f in filt_dict:
-			phot_col[f]=[]
-		mu=1.0/g*(-1.0*g_r*(sin_colat*sin_inc*cos_phi[j]+cos_colat*cos_inc)-g_t*(sin_inc*cos_phi[j]*cos_colat-sin_colat*cos_inc))
-		for i in range(len(colat)):
-			for f in filt_dict:
-				if mu[i] < 0.034962:
-					phot_col[f].append(0.)
-				else:
-					phot_col[f].append(extract_phoenix_phot(T_eff[i],lg[i],mu[i],f,use_filts,phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)*(tht_R[i])**2.*mu[i]*np.sin(colat[i]))
-					
-		for f in filt_dict:
-			phot_phi[f].append(np.trapz(phot_col[f],x=colat))
+	#mu of every (colatitude x longitude) point, and the intensity in every filter at all the visible ones in one go. Only
+	#the longitudes up to pi are needed if the grid is symmetric (see phi_fold)
+	n_phi,phi_unfold=phi_fold(phi)
+	mu=1.0/g[:,None]*(-1.0*g_r[:,None]*(sin_colat[:,None]*sin_inc*cos_phi[None,:n_phi]+cos_colat[:,None]*cos_inc)-g_t[:,None]*(sin_inc*cos_phi[None,:n_phi]*cos_colat[:,None]-sin_colat[:,None]*cos_inc))
+	ii,jj=np.where(mu >= 0.034962)
+	phot_grid=np.zeros((len(use_filts),len(colat),n_phi))
+	if len(ii) > 0:
+		cube=phoenix_cube(T_eff[ii],lg[ii],'phot',phx_dir,phx_dict,use_Z,tg_lists,phx_mu,phx_wav,mode,wl_list)
+		phot_grid[:,ii,jj]=interp_cube(cube,T_eff[ii],lg[ii],mu[ii,jj])*(tht_R[ii])**2.*mu[ii,jj]*np.sin(colat[ii])
+	#Integrate over colatitude, then longitude
+	phot_phi=np.trapz(phot_grid,x=colat,axis=1)[:,phi_unfold]
 	filt_fluxes=dict()
 	phot_dict=dict()
 	phot_diff=[]
 	phot_err=[]
 	for f in filt_dict:
-		filt_fluxes[f]=np.trapz(phot_phi[f],x=phi)
+		filt_fluxes[f]=np.trapz(phot_phi[use_filts.index(f)],x=phi)
 		phot_dict[f]=-2.5*np.log10(filt_fluxes[f]/zpf[f])
 		phot_diff.append(filt_fluxes[f]-zpf[f]*10.**(-0.4*float(phot_data[f][0])))
 		phot_err.append(float(phot_data[f][1])*zpf[f]*0.4*np.log(10.)*10.**(-0.4*float(phot_data[f][0])))
@@ -2162,8 +3297,56 @@ def calc_phot(r,R,tht_R,T_eff,g,g_r,g_t,lg,OMG,phot_data,colat,phi,sin_colat,cos
 	phot_chi2=sum(phot_diff**2./phot_err**2.)/(float(len(phot_diff))-n_params-1.)
 	
 	return phot_chi2
+def planck_tail(x):
+	"""Works out int(from t=x to inf) t^3/(e^t-1) dt, which is what's left of the integral of the blackbody spectrum
+	shortward of the wavelength where x=hc/(lambda k T). Above x=1 this is the sum over n of
+	e^(-nx)*(x^3/n+3x^2/n^2+6x/n^3+6/n^4), cut off after 40 terms, so what's left out is less than e^(-40)/(1-e^(-1)) (7e-18)
+	of the first term. Below x=1 it's pi^4/15 minus the series in Bernoulli numbers for the integral from 0 to x, cut off
+	after B_16. That series alternates, so what's left out is less than the next term (4e-16 at x=1).
+	Inputs:
+	x
+		hc/(lambda k T), as a number or an array
+
+	Outputs:
+	tail
+		The integral, the same shape as x
+	"""
+	x=np.asarray(x,dtype=float)
+	tail=np.zeros(np.shape(x))
+	big=x > 1.
+	xb=x[big]
+	for n in range(1,41):
+		tail[big]+=np.exp(-n*xb)*(xb**3./n+3.*xb**2./n**2.+6.*xb/n**3.+6./n**4.)
+	xs=x[~big]
+	head=xs**3./3.-xs**4./8.	#The B_0 and B_1 terms
+	bern=[1./6.,-1./30.,1./42.,-1./30.,5./66.,-691./2730.,7./6.,-3617./510.]	#B_2, B_4, ..., B_16
+	for j in range(len(bern)):
+		n=2*(j+1)
+		head+=bern[j]*xs**(n+3.)/np.prod(np.arange(1.,n+1.))/(n+3.)
+	tail[~big]=np.pi**4./15.-head
+	return tail
+
+def planck_band(T,lam_lo,lam_hi):
+	"""Integrates the blackbody intensity spectrum from lam_lo to lam_hi in closed form (see planck_tail). The relative
+	error is at the level of the rounding in the two tails that get subtracted, well under 1e-12 for the bands calc_Lbol
+	uses.
+	Inputs:
+	T
+		The temperature(s) in K, as a number or an array
+	lam_lo, lam_hi
+		The ends of the band in cm
+
+	Outputs:
+	B_int
+		int(from lam_lo to lam_hi) B_lambda(T) dlambda in erg/s/cm^2/sr, the same shape as T
+	"""
+	T=np.asarray(T,dtype=float)
+	return 2.*k**4.*T**4./h**3./c**2.*(planck_tail(h*c/k/T/lam_hi)-planck_tail(h*c/k/T/lam_lo))
+
 def calc_Lbol(r,R,tht_R,T_eff,g,g_r,g_t,lg,dist,phx_mu,colat,phi,sin_colat,cos_colat,cos_phi,sin_inc,cos_inc,phx_dir,use_Z,tg_lists,phx_dict,phx_wav,mode,wl_list):
-	"""Calculates the bolometric and apparent luminosities
+	"""Calculates the bolometric and apparent luminosities. The phoenix parts come from the integrated intensities of the
+	phoenix models: the hemispheric fluxes for L_bol (see phoenix_bol) and the wavelength integrated intensity at each mu
+	for L_app (see phoenix_bol_mu), so no spectra get interpolated.
 	Inputs:
 	
 	Outputs:
@@ -2175,32 +3358,24 @@ def calc_Lbol(r,R,tht_R,T_eff,g,g_r,g_t,lg,dist,phx_mu,colat,phi,sin_colat,cos_c
 	R_e,V_e,inc,T_p,pa=r	
 
 	#The wavelength range of the phoenix model I use is limited, so beyond that range (in both directions), I assume blackbody
-	lo_wav=np.arange(400)+100.	#Wavengths < phx_wav (in A)
-	lo_wav/=1e8	#convert lo_wav from A to cm
-	hi_wav=np.arange(5000)*10.+26000.	#Wavelengths > phx_wav (in A)
-	hi_wav/=1e8	#convert hi_wav from A to cm
+	lo_wav=(100e-8,499e-8)	#Wavengths < phx_wav (in cm)
+	hi_wav=(26000e-8,75990e-8)	#Wavelengths > phx_wav (in cm)
+	#Everything intrinsic only needs working out on the northern half of the star if it's symmetric (see colat_fold)
+	n_col,col_unfold=colat_fold(colat,R,T_eff,lg)
+	#The blackbody intensity integrated over each of those ranges (see planck_band)
+	lo_B=planck_band(T_eff[:n_col],lo_wav[0],lo_wav[1])[col_unfold]
+	hi_B=planck_band(T_eff[:n_col],hi_wav[0],hi_wav[1])[col_unfold]
 	
 	integrand=[]
 	lo_integrand=[]
 	hi_integrand=[]
 	#This for loop defines the array over which to integrate to get the total luminosity. The functional form looks like this: L_bol=2 pi int(from x=0 to pi) (I_bol*R^2*sin(x)) dx where x is the colatitude
+	#The mu and wavelength integrated intensity at each colatitude, interpolated from the phoenix models' (see phoenix_bol)
+	I_bols=phoenix_bol(T_eff[:n_col],lg[:n_col],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)[col_unfold]
 	for i in range(len(colat)):
-		I_lam_mu=[]
-		for l in range(len(phx_mu)):
-			II=extract_phoenix_full(T_eff[i],lg[i],phx_mu[l],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)
-			I_lam_mu.append(phx_mu[l]*II)
-		I_lam_mu=np.array(I_lam_mu)
-		I_lam=np.zeros(len(phx_wav))
-		for l in range(len(phx_wav)):
-			if l == 0:
-				I_lam[l]=0.
-			else:
-				I_lam[l]=np.trapz(I_lam_mu[:,l],x=phx_mu)
-		lo_I_lam=2.*h*c**2./(lo_wav)**5.*1./(np.exp(h*c/k/T_eff[i]/(lo_wav))-1)	#Blackbody intensity spectrum for wavelength < phx_wav
-		hi_I_lam=2.*h*c**2./(hi_wav)**5.*1./(np.exp(h*c/k/T_eff[i]/(hi_wav))-1)	#Blackbody intensity spectrum for wavelength > phx_wav
-		I_bol=np.trapz(I_lam,x=phx_wav)*2.*np.pi	#Integrate over wavelength
-		lo_I_bol=np.trapz(lo_I_lam,x=lo_wav)*2.*np.pi
-		hi_I_bol=np.trapz(hi_I_lam,x=hi_wav)*2.*np.pi
+		I_bol=I_bols[i]
+		lo_I_bol=lo_B[i]*2.*np.pi
+		hi_I_bol=hi_B[i]*2.*np.pi
 		integrand.append(I_bol*(R[i]*R_sun)**2.*sin_colat[i])	#Add the results to the array
 		lo_integrand.append(lo_I_bol*(R[i]*R_sun)**2.*sin_colat[i])
 		hi_integrand.append(hi_I_bol*(R[i]*R_sun)**2.*sin_colat[i])
@@ -2211,31 +3386,19 @@ def calc_Lbol(r,R,tht_R,T_eff,g,g_r,g_t,lg,dist,phx_mu,colat,phi,sin_colat,cos_c
 	L_bol=L_lo+L_mid+L_hi
 	if 'o' in mode:
 		print 'L_bol: ',L_bol,' L_sun' 
-	#Calculating L_app
-	i_phi=[]
-	lo_i_phi=[]
-	hi_i_phi=[]
-	for j in range(len(phi)):
-		phot_col=dict()
-		i_col=[]
-		lo_i_col=[]
-		hi_i_col=[]
-		mu=1.0/g*(-1.0*g_r*(sin_colat*sin_inc*cos_phi[j]+cos_colat*cos_inc)-g_t*(sin_inc*cos_phi[j]*cos_colat-sin_colat*cos_inc))
-		for i in range(len(colat)):
-			if mu[i] < 0.034962:
-				i_col.append(0.)
-				lo_i_col.append(0.)
-				hi_i_col.append(0.)
-			else:
-				I_lam=extract_phoenix_full(T_eff[i],lg[i],mu[i],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)*(tht_R[i])**2.*mu[i]*sin_colat[i]
-				i_col.append(np.trapz(I_lam,x=phx_wav))
-				lo_bb=2.*h*c**2./(lo_wav)**5.*1./(np.exp(h*c/k/T_eff[i]/(lo_wav))-1)*(tht_R[i])**2.*mu[i]*sin_colat[i]*2.
-				lo_i_col.append(np.trapz(lo_bb,x=lo_wav))
-				hi_bb=2.*h*c**2./(hi_wav)**5.*1./(np.exp(h*c/k/T_eff[i]/(hi_wav))-1)*(tht_R[i])**2.*mu[i]*sin_colat[i]*2.
-				hi_i_col.append(np.trapz(hi_bb,x=hi_wav))
-		i_phi.append(np.trapz(i_col,x=colat))
-		lo_i_phi.append(np.trapz(lo_i_col,x=colat))
-		hi_i_phi.append(np.trapz(hi_i_col,x=colat))
+	#Calculating L_app. mu for every (phi, colat) point on the grid, and the wavelength integrated intensity at the visible
+	#ones (see phoenix_bol_mu). Only the longitudes up to pi are needed if the grid is symmetric (see phi_fold)
+	n_phi,phi_unfold=phi_fold(phi)
+	mu=1.0/g*(-1.0*g_r*(sin_colat*sin_inc*cos_phi[:n_phi,None]+cos_colat*cos_inc)-g_t*(sin_inc*cos_phi[:n_phi,None]*cos_colat-sin_colat*cos_inc))
+	vis=mu >= 0.034962
+	j_vis,i_vis=np.nonzero(vis)
+	weight=np.zeros(np.shape(mu))
+	weight[vis]=(tht_R[i_vis])**2.*mu[vis]*sin_colat[i_vis]
+	i_int=np.zeros(np.shape(mu))
+	i_int[vis]=phoenix_bol_mu(T_eff[i_vis],lg[i_vis],mu[vis],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)*weight[vis]
+	i_phi=np.trapz(i_int,x=colat,axis=1)[phi_unfold]
+	lo_i_phi=np.trapz(lo_B*weight*2.,x=colat,axis=1)[phi_unfold]
+	hi_i_phi=np.trapz(hi_B*weight*2.,x=colat,axis=1)[phi_unfold]
 
 	lo_F=np.trapz(lo_i_phi,x=phi)
 	mid_F=np.trapz(i_phi,x=phi)
@@ -2337,9 +3500,7 @@ def get_phoenix_wave(phx_dir):
 	"""
 	print 'Using the Phoenix atmospere models'
 	phx_file='Z-0.0/lte07000-4.00-0.0.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits' #An example file to get the dictionary started
-	hdulist = pyfits.open(phx_dir+phx_file) #Read phx_file
-	unfiltered = hdulist[0].data #The intensity array
-	hdulist.close()
+	unfiltered,phx_mu=open_phoenix(phx_dir+'Z-0.0/','lte07000-4.00-0.0.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits') #Read phx_file
 	
 	unfiltered=list(unfiltered)
 	unfiltered=np.array(unfiltered)
@@ -2349,8 +3510,8 @@ def get_phoenix_wave(phx_dir):
 
 def get_complex_trf(arr):
 	print 'get_complex_trf has been called'
-    complex_dtype = dtypes.complex_for(arr.dtype)
-    return Transformation(
+	complex_dtype = dtypes.complex_for(arr.dtype)
+	return Transformation(
         [Parameter('output', Annotation(Type(complex_dtype, arr.shape), 'o')),
         Parameter('input', Annotation(arr, 'i'))],
         """
@@ -2360,6 +3521,234 @@ def get_complex_trf(arr):
                 0));
         """)
 
+def filter_phoenix(this_arr,phx_mu,phx_wav,mode,wl_list):
+	"""Integrates the intensities of a phoenix model over each of the photometric filters and each of the visibility
+	wavelength channels, at each mu. This is one matrix multiply with the weights from band_weights.
+	Inputs:
+	this_arr
+		The (mu x wavelength) array of intensities of the phoenix model
+	phx_mu
+		The list of mu values used by phoenix spectra (with 0 at the front)
+	phx_wav
+		The wavelengths of the phoenix spectra
+	mode
+		The filters are only done if 'p' is in mode and the visibility channels only if 'v' is in mode.
+	wl_list
+		[use_filts,filt_dict,uni_wl,uni_dwl]
+	
+	Outputs:
+	phot_filtered
+		A (filter x mu) array of the intensity integrated over each filter (an empty list if 'p' isn't in mode)
+	vis_filtered
+		A (visibility wavelength x mu) array of the intensity integrated over each channel (an empty list if 'v' isn't in mode)
+	"""
+	weights=band_weights(phx_wav,mode,wl_list)
+	this_arr=np.asarray(this_arr,dtype=float)[:len(phx_mu)-1]
+	
+	phot_filtered=[]
+	if 'p' in mode:
+		phot_filtered=np.dot(this_arr,weights['phot']).T
+	
+	vis_filtered=[]
+	if 'v' in mode:
+		vis_filtered=np.dot(this_arr,weights['vis']).T
+		#The integration leaves out wavelengths where the intensity isn't positive, which only matters (and isn't in the
+		#weights) when that happens at the edge of, or inside, a channel. Those few are done the old way.
+		for i in range(len(weights['vis_lo'])):
+			lo=weights['vis_lo'][i]
+			hi=weights['vis_hi'][i]
+			for j in np.where(np.any(this_arr[:,lo:hi] <= 0.,axis=1))[0]:
+				not_inted=this_arr[j,lo:hi]/wl_list[3][i]
+				vis_filtered[i,j]=do_phx_integrate(not_inted[np.where(not_inted > 0)])
+	return phot_filtered,vis_filtered
+
+def band_weights(phx_wav,mode,wl_list):
+	"""Sets up the (wavelength x band) matrices that do the integrals over the photometric filters and visibility
+	channels in filter_phoenix as one matrix multiply. Multiplying by them gives the same thing as applying each filter
+	(over the fwhm of the filter, or the width of the channel) to a spectrum, keeping the wavelengths where that isn't 0,
+	and integrating those with the trapezoid rule. They're only set up once per set of bands (kept in phx_weights).
+	Inputs:
+	phx_wav
+		The wavelengths of the phoenix spectra
+	mode
+		The filters are only done if 'p' is in mode and the visibility channels only if 'v' is in mode.
+	wl_list
+		[use_filts,filt_dict,uni_wl,uni_dwl]
+	
+	Outputs:
+	weights
+		Dictionary with the filter ('phot') and channel ('vis') matrices, and the range of wavelength indices each
+		channel covers ('vis_lo' up to but not including 'vis_hi')
+	"""
+	use_filts,filt_dict,uni_wl,uni_dwl=wl_list
+	key=(len(phx_wav),phx_wav[0],phx_wav[-1],'p' in mode,'v' in mode,band_key(wl_list))
+	if key in phx_weights:
+		return phx_weights[key]
+	weights={'phot':None,'vis':None,'vis_lo':[],'vis_hi':[]}
+	if 'p' in mode:
+		weights['phot']=np.zeros((len(phx_wav),len(use_filts)))
+		for i in range(len(use_filts)):
+			the_filter=np.asarray(filt_dict[use_filts[i]],dtype=float)
+			used=np.where(the_filter > 0)[0]
+			weights['phot'][used,i]=trapz_weights(len(used))*the_filter[used]/fwhm(phx_wav,the_filter)/1e8
+	if 'v' in mode:
+		weights['vis']=np.zeros((len(phx_wav),len(uni_wl)))
+		for i in range(len(uni_wl)):
+			#The top-hat filter response curve of the visibility observations
+			used=np.where((phx_wav/100. > uni_wl[i]-uni_dwl[i]/2.) & (phx_wav/100. <= uni_wl[i]+uni_dwl[i]/2.))[0]
+			weights['vis'][used,i]=trapz_weights(len(used))/uni_dwl[i]
+			if len(used) > 0:
+				weights['vis_lo'].append(used[0])
+				weights['vis_hi'].append(used[-1]+1)
+			else:
+				weights['vis_lo'].append(0)
+				weights['vis_hi'].append(0)
+	phx_weights[key]=weights
+	return weights
+
+def trapz_weights(n):
+	"""The weights do_phx_integrate gives each of n evenly spaced points
+	Inputs:
+	n
+		The number of points
+	
+	Outputs:
+	weights
+		Array of the weights
+	"""
+	weights=np.ones(n)*1.e-8
+	if n > 0:
+		weights[0]*=0.5
+		weights[-1]*=0.5
+	if n == 1:
+		weights[0]=0.
+	return weights
+
+def band_key(wl_list):
+	"""Gives a key for the contents of a set of bands: the filter names, a CRC of each filter's response curve, uni_wl, and
+	uni_dwl. It's cheap enough to work out on every call, so what's worked out for a set of bands is kept under this
+	rather than under the filt_dict object, and a filter curve that's changed in the same filt_dict gets a new key.
+	Inputs:
+	wl_list
+		[use_filts,filt_dict,uni_wl,uni_dwl]
+	
+	Outputs:
+	key
+		A tuple to use as (part of) a dictionary key
+	"""
+	import zlib
+	use_filts,filt_dict,uni_wl,uni_dwl=wl_list
+	crcs=tuple(zlib.crc32(np.ascontiguousarray(filt_dict[f],dtype=float)) for f in use_filts)
+	return (tuple(use_filts),crcs,tuple(uni_wl),tuple(uni_dwl))
+
+def band_cache_file(fits_dir,wl_list):
+	"""Gives the name of the file that the band integrated phoenix intensities for a set of filters and visibility channels
+	are (or would be) saved in by precompute_bands. The name has a hash of the filter curves, uni_wl, and uni_dwl in it,
+	so a different set of bands never picks up the wrong tables.
+	Inputs:
+	fits_dir
+		The directory the phoenix spectra for one metallicity are located in, e.g. phx_dir+'Z-0.0/'
+	wl_list
+		[use_filts,filt_dict,uni_wl,uni_dwl]
+	
+	Outputs:
+	cache_file
+		The name of the file
+	"""
+	import hashlib
+	use_filts,filt_dict,uni_wl,uni_dwl=wl_list
+	key=(fits_dir,band_key(wl_list))
+	if key in band_files:
+		return band_files[key]
+	bands=hashlib.sha1()
+	for f in use_filts:
+		bands.update(f)
+		bands.update(np.asarray(filt_dict[f],dtype=float).tostring())
+	bands.update(np.asarray(uni_wl,dtype=float).tostring())
+	bands.update(np.asarray(uni_dwl,dtype=float).tostring())
+	band_files[key]=fits_dir.rstrip('/')+'_bands_'+bands.hexdigest()[:16]+'.npz'
+	return band_files[key]
+
+def precompute_bands(phx_dir,use_Z,wl_list,fetch=True):
+	"""Integrates every model of the phoenix grid over the photometric filters and visibility channels once and saves the
+	results (see band_cache_file). After that, models that are in there never have to have their full spectra read just
+	to do photometry or visibilities (see cached_bands). Models that aren't in phx_dir (as FITS files or packed) are
+	fetched from phx_source into it first (see prefetch_phoenix). Any that still aren't there are listed and left out, and
+	runs fall back on reading their full spectra.
+	Inputs:
+	phx_dir
+		The directory the phoenix spectra are located in (without the metallicity)
+	use_Z
+		The metallicity of the phoenix model spectra
+	wl_list
+		[use_filts,filt_dict,uni_wl,uni_dwl]
+	fetch
+		If False, only the models already in phx_dir are integrated
+	
+	Outputs:
+	cache_file
+		The name of the file that was written
+	skipped
+		List of the models of the grid that weren't integrated
+	"""
+	fits_dir=phx_dir+use_Z+'/'
+	cache_file=band_cache_file(fits_dir,wl_list)
+	teff_list,logg_list,str_teff_list,str_logg_list=phoenix_tg_lists()
+	teff_range=[teff_list[0],teff_list[-1]]
+	logg_range=[logg_list[0],logg_list[-1]]
+	if fetch:
+		prefetch_phoenix(phx_dir,use_Z,teff_range,logg_range)
+	grid=reachable_phoenix(teff_range,logg_range,use_Z,[teff_list,logg_list,str_teff_list,str_logg_list])
+	files=[f for f in set(phoenix_files(fits_dir)) if f.startswith('lte') and f.endswith('.PHOENIX-ACES-AGSS-COND-SPECINT-2011.fits')]
+	files.sort(key=lambda f: (int(f[3:8]),abs(float(f[8:13]))))
+	have=set(files)
+	skipped=[f for f in grid if f not in have]
+	phot=[]
+	vis=[]
+	for i in range(len(files)):
+		print 'Integrating {} ({} of {})'.format(files[i],i+1,len(files))
+		this_arr,this_mu=open_phoenix(fits_dir,files[i])
+		phx_mu=np.concatenate((np.array([0.]),this_mu))
+		phx_wav=(np.arange(np.shape(this_arr)[1])+500.)*1e-8
+		phot_filtered,vis_filtered=filter_phoenix(this_arr,phx_mu,phx_wav,'pv',wl_list)
+		phot.append(phot_filtered)
+		vis.append(vis_filtered)
+	np.savez(cache_file,files=np.array(files),phot=np.array(phot,dtype=band_dtype()).reshape(len(files),len(wl_list[0]),-1),
+		vis=np.array(vis,dtype=band_dtype()).reshape(len(files),len(wl_list[2]),-1),use_filts=np.array(wl_list[0]),uni_wl=np.array(wl_list[2]),uni_dwl=np.array(wl_list[3]))
+	phx_bands.pop(cache_file,None)
+	phx_catalogs.clear()
+	if len(skipped) > 0:
+		print '{} models of the grid aren\'t in {}, so runs will read their full spectra if they need them:'.format(len(skipped),fits_dir)
+		for this_file in skipped:
+			print '    {}'.format(this_file)
+	return cache_file,skipped
+
+def cached_bands(this_file,fits_dir,wl_list):
+	"""Gets the precomputed band integrated intensities of a phoenix model (see precompute_bands), if there are any.
+	Inputs:
+	this_file
+		The phoenix .fits file
+	fits_dir
+		The directory the phoenix spectra for one metallicity are located in, e.g. phx_dir+'Z-0.0/'
+	wl_list
+		[use_filts,filt_dict,uni_wl,uni_dwl]
+	
+	Outputs:
+	bands
+		None if this model hasn't been precomputed for these bands. Otherwise [phot_filtered,vis_filtered]
+		(as from filter_phoenix, but as arrays)
+	"""
+	cache_file=band_cache_file(fits_dir,wl_list)
+	if cache_file not in phx_bands:
+		phx_bands[cache_file]=dict()
+		if phx_tables and os.path.isfile(cache_file):
+			tables=np.load(cache_file)
+			phot=tables['phot']
+			vis=tables['vis']
+			for i,f in enumerate(tables['files']):
+				phx_bands[cache_file][str(f)]=[phot[i],vis[i]]
+	return phx_bands[cache_file].get(this_file)
+
 def do_phx_integrate(y):
 	z=np.trapz(y,dx=1.e-8)
 	return z
@@ -2553,7 +3942,11 @@ def plot_phot(R,tht_R,T_eff,g,g_r,g_t,lg,OMG,V_e,inc,phx_wav,phx_dir,use_Z,tg_li
 				for kk in phx_flux_dict:
 					phd_col[kk].append(0.)
 			else:
-				I_lam=extract_phoenix_full(T_eff[i],lg[i],mu[i],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)*(tht_R[i])**2.*mu[i]*np.sin(colat[i])
+				if 'c' in mode:
+					pca=open_phoenix_pca(phx_dir+use_Z+'/')
+					I_lam=np.dot(extract_phoenix_pca(T_eff[i],lg[i],mu[i],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list),pca['basis'])*(tht_R[i])**2.*mu[i]*np.sin(colat[i])
+				else:
+					I_lam=extract_phoenix_full(T_eff[i],lg[i],mu[i],phx_dir,use_Z,tg_lists,phx_mu,phx_dict,phx_wav,mode,wl_list)*(tht_R[i])**2.*mu[i]*np.sin(colat[i])
 				if 'd' in mode:
 					#print 'Colat: {} || Phi: {}'.format(180./np.pi*colat[i],180./np.pi*phi[j])
 					#Tangential Velocity - km/s
@@ -0,0 +1,37 @@
+import OSMlib as osm
+import numpy as np
+import time
+
+def main():
+	#Times how long it takes to set up the surface grid (OSMlib.surface_grid) as the grid gets finer,
+	#and how long the star's perimeter (OSMlib.limb_perimeter) takes as it gets finer
+	p=[2.5,200.,52.*np.pi/180.,10000.,40.*np.pi/180.+np.pi/2.]	#[R_e,vel,inc,T_p,pa]
+	m=2.
+	beta=0.25
+	dist=30.
+	mode='z'
+	sizes=[[20,30],[50,100],[100,200],[200,400],[400,800],[800,1600]]
+	n_reps=10
+
+	print '{:>9} {:>9} {:>10} {:>12} {:>15}'.format('colat_len','phi_len','points','time (ms)','per point (ns)')
+	for colat_len,phi_len in sizes:
+		start=time.time()
+		for i in range(n_reps):
+			colat,phi,sin_colat,cos_colat,cos_phi,R_p,lomg,OMG,g_p,bet,R,tht_R,g,g_r,g_t,lg,T_eff,mu,x,y,z=osm.surface_grid(p,m,beta,dist,colat_len,phi_len,mode)
+			above=(z >= 0.)&(mu > 0.)
+			x_above=x[above]
+			y_above=y[above]
+		grid_time=(time.time()-start)/n_reps
+		print '{:>9} {:>9} {:>10} {:>12.3f} {:>15.1f}'.format(colat_len,phi_len,colat_len*phi_len,grid_time*1e3,grid_time/(colat_len*phi_len)*1e9)
+	
+	print ''
+	print '{:>9} {:>12}'.format('perim_len','time (ms)')
+	for perim_len in [50,100,200,400,800,1600]:
+		start=time.time()
+		for i in range(n_reps):
+			perim_x,perim_y=osm.limb_perimeter(p,R_p,lomg,dist,perim_len)
+		perim_time=(time.time()-start)/n_reps
+		print '{:>9} {:>12.3f}'.format(perim_len,perim_time*1e3)
+
+if __name__=='__main__':
+	main()
@@ -103,12 +103,11 @@ def main():
 		r.append([R_e[i],V_e[i],inc[i]*np.pi/180.,T_p[i],pa[i]*np.pi/180.+np.pi/2.])
 	g_scale=1.
 	
+	#Load the phoenix models the chain can reach before it starts again
 	empty_phx_dict=dict()
+	teff_range,logg_range=osm.warm_ranges(r[-1],scale,m,beta,dist,mode)
+	osm.warm_phoenix(phx_dir,use_Z,empty_phx_dict,mode,[use_filts,filt_dict,uni_wl,uni_dwl],teff_range,logg_range)
 	first_chi2,phx_dict,g_points,extras=osm.osm(r[0],[base_chi2,m,beta,dist,vis,vis_err,phot_data,wl,u_l,v_l,uni_wl,uni_dwl,g_scale,phx_dir,use_Z,use_filts,filt_dict,zpf,empty_phx_dict,colat_len,phi_len,mode])
-	if 'v' in mode:
-		print 'Increasing the scale so that the number of points is ~1000. This will be the base chi2'
-		g_scale=np.sqrt(1000./g_points)
-		first_chi2,phx_dict,g_points,extras=osm.osm(r[0],[first_chi2,m,beta,dist,vis,vis_err,phot_data,wl,u_l,v_l,uni_wl,uni_dwl,g_scale,phx_dir,use_Z,use_filts,filt_dict,zpf,phx_dict,colat_len,phi_len,mode])
 	
 	n=nums[-1]+1
 	mc.mcmc(r,n,nn,acc,acc_Re,acc_Ve,acc_inc,acc_Tp,acc_pa,scale,total_time_start,end_model_at,free_params,base_chi2,m,beta,dist,vis,vis_err,phot_data,wl,u_l,v_l,uni_wl,uni_dwl,g_scale,phx_dir,use_Z,use_filts,filt_dict,zpf,phx_dict,colat_len,phi_len,mode,vsini,vsini_err,inp_file,the_params)
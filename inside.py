@@ -50,6 +50,37 @@ def inside_worker(r):
 
 	return ins
 
+def inside_grid(xs,ys,xpts,ypts):
+	#Scanline version of inside for a grid of points. Each row of the grid has one y, so each edge of the perimeter
+	#gives one crossing per row and a point is inside if an odd number of crossings are at or to its right.
+	#Gives the same answer as inside for every point.
+	#Inputs:
+	#xs: 1D array of the x-coordinates of the columns of the grid
+	#ys: 1D array of the y-coordinates of the rows of the grid
+	#xpts,ypts: 1D arrays of x,y-coordinates of the (closed) perimeter, as from sort_hull_results
+	#Outputs:
+	#ins: (len(ys),len(xs)) boolean array, True where the point is inside the perimeter
+	xs=asarray(xs,dtype=float)
+	ys=asarray(ys,dtype=float)
+	p1x=asarray(xpts[:-1],dtype=float)
+	p1y=asarray(ypts[:-1],dtype=float)
+	p2x=asarray(xpts[1:],dtype=float)
+	p2y=asarray(ypts[1:],dtype=float)
+	keep=p1y != p2y	#Horizontal edges never count
+	p1x,p1y,p2x,p2y=p1x[keep],p1y[keep],p2x[keep],p2y[keep]
+	
+	y=ys[:,newaxis]
+	crosses=(y > minimum(p1y,p2y))&(y <= maximum(p1y,p2y))	#Which edges each row crosses
+	xints = (y-p1y)*(p2x-p1x)/(p2y-p1y)+p1x
+	xints = where(p1x == p2x,p1x,minimum(xints,maximum(p1x,p2x)))	#A point counts the crossing if it's at or left of this
+	xints = where(crosses,xints,-inf)
+	xints.sort(axis=1)
+	ins=zeros((len(ys),len(xs)),dtype=bool)
+	for i in range(len(ys)):
+		n_right=xints.shape[1]-searchsorted(xints[i],xs,side='left')	#Crossings at or to the right of each point
+		ins[i]=(n_right % 2) == 1
+	return ins
+
 def point_in_poly(x,y,poly):
     n = len(poly)
     inside = False
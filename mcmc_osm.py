@@ -76,16 +76,15 @@ def main():
 	
 	g_scale=1.
 	
-	empty_phx_dict=dict()
-	base_chi2,phx_dict,g_points,extras=osm.osm(r[0],[base_chi2,m,beta,dist,vis,vis_err,phot_data,wl,u_l,v_l,uni_wl,uni_dwl,g_scale,phx_dir,use_Z,use_filts,filt_dict,zpf,empty_phx_dict,colat_len,phi_len,mode])
-	if 'v' in mode:
-		print 'Increasing the scale so that the number of points is ~1000. This will be the base chi2'
-		g_scale=np.sqrt(1000./g_points)
-		base_chi2,phx_dict,g_points,extras=osm.osm(r[0],[base_chi2,m,beta,dist,vis,vis_err,phot_data,wl,u_l,v_l,uni_wl,uni_dwl,g_scale,phx_dir,use_Z,use_filts,filt_dict,zpf,phx_dict,colat_len,phi_len,mode])
-
 	scale=[0.08,15.,3.*np.pi/180.,130.,43.*np.pi/180.] #The initial range for mcmc to search over
 	scale=np.array(scale)
 	
+	#Load the phoenix models the chain can reach before it starts
+	empty_phx_dict=dict()
+	teff_range,logg_range=osm.warm_ranges(r[0],scale,m,beta,dist,mode)
+	osm.warm_phoenix(phx_dir,use_Z,empty_phx_dict,mode,[use_filts,filt_dict,uni_wl,uni_dwl],teff_range,logg_range)
+	base_chi2,phx_dict,g_points,extras=osm.osm(r[0],[base_chi2,m,beta,dist,vis,vis_err,phot_data,wl,u_l,v_l,uni_wl,uni_dwl,g_scale,phx_dir,use_Z,use_filts,filt_dict,zpf,empty_phx_dict,colat_len,phi_len,mode])
+
 	lock_Re=False
 	lock_vel=False
 	lock_inc=False
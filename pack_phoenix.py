@@ -0,0 +1,18 @@
+import OSMlib as osm
+import sys
+
+def main():
+	#Packs the phoenix SPECINT files for one metallicity into one memory mapped file (see OSMlib.pack_phoenix).
+	#Once it's there, OSMlib reads the intensities from it instead of from the FITS files.
+	#Usage: python pack_phoenix.py phx_dir [use_Z]
+	phx_dir=sys.argv[1]
+	if not phx_dir.endswith('/'):
+		phx_dir+='/'
+	use_Z='Z-0.0'
+	if len(sys.argv) > 2:
+		use_Z=sys.argv[2]
+	pack_file=osm.pack_phoenix(phx_dir,use_Z)
+	print 'Wrote {}'.format(pack_file)
+
+if __name__=='__main__':
+	main()
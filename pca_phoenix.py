@@ -0,0 +1,21 @@
+import OSMlib as osm
+import sys
+
+def main():
+	#Compresses the phoenix SPECINT files for one metallicity onto a small set of basis spectra (see OSMlib.pca_phoenix)
+	#and prints how well the spectra are reconstructed. Runs with 'c' in the mode use it for plots.
+	#Usage: python pca_phoenix.py phx_dir [use_Z] [n_basis]
+	phx_dir=sys.argv[1]
+	if not phx_dir.endswith('/'):
+		phx_dir+='/'
+	use_Z='Z-0.0'
+	if len(sys.argv) > 2:
+		use_Z=sys.argv[2]
+	n_basis=60
+	if len(sys.argv) > 3:
+		n_basis=int(sys.argv[3])
+	pca_file=osm.pca_phoenix(phx_dir,use_Z,n_basis)
+	print 'Wrote {}'.format(pca_file)
+
+if __name__=='__main__':
+	main()
@@ -0,0 +1,41 @@
+import OSMlib as osm
+import sys
+
+def main():
+	#Integrates the whole phoenix grid over the filters and visibility channels of a star once and saves the results
+	#(see OSMlib.precompute_bands), so runs on that star don't have to read full spectra just for photometry or
+	#visibilities. Models that aren't in the Atmo Directory are fetched from OSMlib.phx_source into it first; any that
+	#can't be (or all of them, with local) are listed and left out, and runs read their full spectra instead.
+	#Also saves the models' integrated intensities for L_bol and L_app (see OSMlib.precompute_bol).
+	#Usage: python precompute_bands.py input_file [local]
+	input_dict=osm.read_input(sys.argv[1])
+	
+	star=input_dict['Star']
+	star_dir=input_dict['Star Directory']+star+'/'
+	phx_dir=input_dict['Atmo Directory']
+	filt_dir=input_dict['Filter Directory']
+	use_Z='Z-0.0'
+	vis_inp=star_dir+star+'.vis'	#Visibility input file
+	phot_inp=star_dir+star+'.phot'	#Photometry input file
+	
+	wl,wlerr,vis,vis_err,u_m,v_m,u_l,v_l,cal=osm.read_vis(vis_inp)
+	phot_data,use_filts=osm.read_phot(phot_inp)
+	cwl,zpf=osm.read_cwlzpf(filt_dir+'cwlzpf.txt')
+	wav=osm.get_phoenix_wave(phx_dir)
+	filt_dict=osm.read_filters(use_filts,filt_dir,cwl,wav)
+	
+	uni_wl=[]	#What are all the unique wavlengths in this observation
+	uni_dwl=[] #The fwhm of the unique wavelengths observed
+	for i in range(len(wl)):
+		if wl[i] not in uni_wl:
+			uni_wl.append(wl[i])
+			uni_dwl.append(wlerr[i])
+	
+	fetch=not (len(sys.argv) > 2 and sys.argv[2] == 'local')
+	cache_file,skipped=osm.precompute_bands(phx_dir,use_Z,[use_filts,filt_dict,uni_wl,uni_dwl],fetch)
+	print 'Wrote {} ({} models of the grid left out)'.format(cache_file,len(skipped))
+	bol_file=osm.precompute_bol(phx_dir,use_Z)
+	print 'Wrote {}'.format(bol_file)
+
+if __name__=='__main__':
+	main()
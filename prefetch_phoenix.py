@@ -0,0 +1,28 @@
+import OSMlib as osm
+import sys
+
+def main():
+	#Fetches every phoenix model a run over the given T_eff and log(g) ranges could need into phx_dir
+	#(see OSMlib.prefetch_phoenix), so the run doesn't have to stop and download them.
+	#Usage: python prefetch_phoenix.py phx_dir teff_min teff_max logg_min logg_max [source] [use_Z]
+	#source is a URL or directory holding the grid (without the metallicity), by default the phoenix ftp site
+	phx_dir=sys.argv[1]
+	if not phx_dir.endswith('/'):
+		phx_dir+='/'
+	teff_range=[float(sys.argv[2]),float(sys.argv[3])]
+	logg_range=[float(sys.argv[4]),float(sys.argv[5])]
+	source=None
+	if len(sys.argv) > 6:
+		source=sys.argv[6]
+		if not source.endswith('/'):
+			source+='/'
+	use_Z='Z-0.0'
+	if len(sys.argv) > 7:
+		use_Z=sys.argv[7]
+	fetched,failed=osm.prefetch_phoenix(phx_dir,use_Z,teff_range,logg_range,source)
+	print 'Fetched {} models, {} failed'.format(len(fetched),len(failed))
+	for this_file in failed:
+		print '    {}'.format(this_file)
+
+if __name__=='__main__':
+	main()
@@ -71,8 +71,6 @@ def main():
 	r5=[R_e,V_e,Inc*np.pi/180.,T_p+1000.,PA*np.pi/180.+np.pi/2.]
 	
 	phx_dict=dict()
-	chi2,phx_dict,g_points,extras=osm.osm(r1,[base_chi2,m,beta,dist,vis,vis_err,phot_data,wl,u_l,v_l,u_m,v_m,uni_wl,uni_dwl,g_scale,phx_dir,use_Z,use_filts,filt_dict,zpf,cwl,phx_dict,colat_len,phi_len,cal,star,model,model_dir,mode])
-	g_scale=np.sqrt(1000./g_points)
 
 	#if input_dict['Do Plot'] == 'Y': mode+='P'
 
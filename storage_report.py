@@ -0,0 +1,12 @@
+import OSMlib as osm
+import sys
+
+def main():
+	#Runs the model in an input file with the phoenix models stored as read, as float32, and as scaled float16
+	#(see OSMlib.phx_storage) and prints how much chi^2 and the luminosities change, and the memory used.
+	#Usage: python storage_report.py input_file
+	r,data=osm.input_model(sys.argv[1],'L')	#Always do the luminosities, so they can be compared
+	osm.storage_report(r,data)
+
+if __name__=='__main__':
+	main()
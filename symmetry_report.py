@@ -0,0 +1,13 @@
+import OSMlib as osm
+import sys
+
+def main():
+	#Runs the model in an input file with the surface integrals done over the whole star and over the half of it that
+	#symmetry allows (see OSMlib.use_symmetry), and prints how much chi^2 and the luminosities change, and the time taken.
+	#Stops with an error if they don't agree to rounding.
+	#Usage: python symmetry_report.py input_file
+	r,data=osm.input_model(sys.argv[1],'L')	#Always do the luminosities, so they can be compared
+	osm.symmetry_report(r,data)
+
+if __name__=='__main__':
+	main()